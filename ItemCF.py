@@ -14,6 +14,8 @@ import random
 import math
 import operator
 
+from evaluation import evaluate_rank
+
 
 def split_data(data, M, k, seed):
     """
@@ -133,6 +135,21 @@ def popularity(train, test, N):
     return ret
 
 
+def evaluate(train, test, N, get_rank=None):
+    """
+    单次遍历计算所有评估指标，见evaluation.evaluate_rank
+    :param train: 训练集，{user: 用户有过行为的物品}
+    :param test: 测试集，{user: 用户有过行为的物品}
+    :param N: 推荐列表长度
+    :param get_rank: 生成推荐列表的函数get_rank(user, N)，为None时使用get_recommendation
+    :return: {'recall', 'precision', 'coverage', 'popularity', 'ndcg', 'hit_rate'}
+    """
+    if get_rank is None:
+        get_rank = get_recommendation
+
+    return evaluate_rank(train, test, N, get_rank)
+
+
 def item_similarity(train):
     # calculate co-rated users between items
     C = dict()
@@ -14,6 +14,8 @@ import random
 import math
 import operator
 
+from evaluation import evaluate_rank
+
 
 def split_data(data, M, k, seed):
     """
@@ -121,6 +123,27 @@ def popularity(train, test, N):
     return ret
 
 
+def evaluate(train, test, N, get_rank=None, K=80):
+    """
+    单次遍历计算所有评估指标，见evaluation.evaluate_rank
+    :param train: 训练集，{user: 用户有过行为的物品}
+    :param test: 测试集，{user: 用户有过行为的物品}
+    :param N: 推荐列表长度
+    :param get_rank: 生成推荐列表的函数get_rank(user, N)，为None时用user_similarity_v3和recommend推荐
+    :param K: get_rank为None时使用的相似用户个数
+    :return: {'recall', 'precision', 'coverage', 'popularity', 'ndcg', 'hit_rate'}
+    """
+    if get_rank is None:
+        # 用户相似度只计算一次，所有用户共用
+        W = user_similarity_v3(train)
+
+        def get_rank(user, n):
+            rank = recommend(user, train, W, K)
+            return sorted(rank.items(), key=operator.itemgetter(1), reverse=True)[0:n]
+
+    return evaluate_rank(train, test, N, get_rank)
+
+
 def user_similarity(train):
     W = dict()
     for u in train.keys():
@@ -210,13 +233,15 @@ def get_recommendation(user, train, N):
 
 def recommend(user, train, W, K):
     rank = dict()
-    interacted_items = train[user]
-    for v, wuv in sorted(W.items(), key=operator.itemgetter(1), reverse=True)[0:K]:
-        for i, rvi in train[v].items():
+    interacted_items = set(train[user])
+    # 与user最相似的K个用户，W为user_similarity_v3的结果
+    for v, wuv in sorted(W.get(user, {}).items(), key=operator.itemgetter(1), reverse=True)[0:K]:
+        for i in train[v]:
             if i in interacted_items:
                 # We should filter items user interacted before
                 continue
-            rank[i] += wuv * rvi
+            # 隐反馈数据，用户v对有过行为的物品的兴趣rvi为1
+            rank[i] = rank.get(i, 0) + wuv
     return rank
 
 
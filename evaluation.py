@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+
+"""
+@version: 1.0
+@software: PyCharm Community Edition
+@file: evaluation.py
+"""
+
+import math
+
+
+def evaluate_rank(train, test, N, get_rank):
+    """
+    单次遍历计算所有评估指标，每个用户的推荐列表只生成一次
+    包括召回率、准确率、覆盖率、流行度，以及NDCG和命中率(至少命中一个物品的用户比例)
+    :param train: 训练集，{user: 用户有过行为的物品}
+    :param test: 测试集，{user: 用户有过行为的物品}
+    :param N: 推荐列表长度
+    :param get_rank: 生成推荐列表的函数get_rank(user, N)，返回[(item, pui)]或{item: pui}，按pui从大到小排列
+    :return: {'recall', 'precision', 'coverage', 'popularity', 'ndcg', 'hit_rate'}
+    """
+    # 物品流行度只计算一次
+    item_popularity = dict()
+    for user, items in train.items():
+        for item in items:
+            item_popularity[item] = item_popularity.get(item, 0) + 1
+
+    # 位置i(从0开始)的折损系数
+    discounts = [1.0 / math.log2(i + 2) for i in range(N)]
+
+    hit = 0
+    test_all = 0
+    recommend_all = 0
+    hit_users = 0
+    ndcg = 0.0
+    popularity_sum = 0.0
+    recommend_items = set()
+    for user in train.keys():
+        tu = test.get(user, {})
+        rank = get_rank(user, N)
+        if isinstance(rank, dict):
+            rank = rank.items()
+
+        user_hit = 0
+        dcg = 0.0
+        for position, (item, pui) in enumerate(rank):
+            if item in tu:
+                user_hit += 1
+                if position < N:
+                    dcg += discounts[position]
+            recommend_items.add(item)
+            popularity_sum += math.log(1 + item_popularity.get(item, 0))
+            recommend_all += 1
+
+        hit += user_hit
+        test_all += len(tu)
+        if user_hit > 0:
+            hit_users += 1
+        ideal = sum(discounts[:min(len(tu), N)])
+        if ideal > 0:
+            ndcg += dcg / ideal
+
+    n_users = len(train)
+    return {
+        'recall': hit / (test_all * 1.0) if test_all else 0.0,
+        'precision': hit / (n_users * N * 1.0) if n_users and N else 0.0,
+        'coverage': len(recommend_items) / (len(item_popularity) * 1.0) if item_popularity else 0.0,
+        'popularity': popularity_sum / (recommend_all * 1.0) if recommend_all else 0.0,
+        'ndcg': ndcg / n_users if n_users else 0.0,
+        'hit_rate': hit_users / (n_users * 1.0) if n_users else 0.0,
+    }
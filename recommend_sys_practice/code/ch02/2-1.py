@@ -14,26 +14,119 @@ import os
 import json
 import random
 import math
+import multiprocessing
+
+import numpy as np
+import scipy.sparse as sp
+
+# binary缓存中用户的选取方式，选取方式变化后旧的缓存不再可用
+USER_SAMPLING = 'hash'
+
+
+def parse_movie_file(path):
+    """
+    解析Netflix训练集中的一个电影文件，第一行为"电影ID:"，之后每行为"用户ID,评分,日期(yyyy-mm-dd)"
+    把','和'-'都换成空白后交给numpy的C解析器，每行得到5个整数
+    @param path: 文件路径
+    @return: (电影ID, 用户ID数组(int32), 评分数组(int8))
+    """
+    with open(path, mode='rb') as fp:
+        movie_id = int(fp.readline().split(b':')[0])
+        content = fp.read()
+    values = np.fromstring(content.replace(b',', b' ').replace(b'-', b' ').decode('ascii'), dtype=np.int64, sep=' ')
+    if len(values) % 5 != 0:
+        raise ValueError(f'电影文件格式错误: {path}')
+    values = values.reshape(-1, 5)
+    return movie_id, values[:, 0].astype(np.int32), values[:, 1].astype(np.int8)
+
+
+def user_hash(users, seed):
+    """
+    带种子的用户ID哈希(splitmix64)，同一个种子下每个用户的哈希值固定，与文件的遍历顺序和分批方式无关
+    @param users: 用户ID数组
+    @param seed: 随机数种子
+    @return: uint64数组
+    """
+    with np.errstate(over='ignore'):
+        x = users.astype(np.uint64) + np.uint64(seed) * np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+def smallest_hash_users(users, seed, n_users):
+    """
+    哈希值最小的n_users个用户，哈希值相同时按用户ID排序
+    @param users: 用户ID数组，可以有重复
+    @param seed: 随机数种子
+    @param n_users: 选取的用户数
+    @return: 升序排列的用户ID数组
+    """
+    distinct = np.unique(users)
+    order = np.lexsort((distinct, user_hash(distinct, seed)))
+    return np.sort(distinct[order[:n_users]])
+
+
+def parse_sampled_ratings(task):
+    """
+    解析一批电影文件，只保留这批文件中哈希值最小的n_users个用户的评分
+    全局哈希值最小的n_users个用户在任意一批文件中也一定在最小的n_users个之内，主进程合并后再选一次即可
+    @param task: (文件路径列表, 随机数种子, n_users)
+    @return: (用户ID数组, 电影ID数组, 评分数组)，按文件和文件中的行排列
+    """
+    paths, seed, n_users = task
+    parsed = [parse_movie_file(path) for path in paths]
+    if not parsed:
+        return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int8)
+    users = np.concatenate([one[1] for one in parsed])
+    movies = np.repeat(np.asarray([one[0] for one in parsed], dtype=np.int32), [len(one[1]) for one in parsed])
+    rates = np.concatenate([one[2] for one in parsed])
+    keep = np.isin(users, smallest_hash_users(users, seed, n_users))
+    return users[keep], movies[keep], rates[keep]
+
+
+def ratings_to_dict(users, movies, rates):
+    """
+    转换为{user: {movie: rate}}形式的字典，ID为字符串，与train.json/test.json的内容一致
+    """
+    result = dict()
+    for user, movie, rate in zip(users.tolist(), movies.tolist(), rates.tolist()):
+        result.setdefault(str(user), {})[str(movie)] = rate
+    return result
 
 
 class FirstRec(object):
-    def __init__(self, file_path, seed, k, n_items):
+    def __init__(self, file_path, seed, k, n_items, loader='binary', processes=None):
         """
         初始化函数
         @param file_path: 原始文件路径
         @param seed: 产生随机数的种子
         @param k: 选取的近邻用户个数
         @param n_items: 为每个用户推荐的电影数
+        @param loader: 数据加载方式，binary为多进程一次遍历并缓存为二进制文件，json为原来两次遍历并缓存为JSON的方式
+        @param processes: binary方式解析文件的进程数，为None时使用全部CPU
         """
         super().__init__()
+        if loader not in ('binary', 'json'):
+            raise ValueError(f'不支持的数据加载方式: {loader}')
         self.train_json_path = 'recommend_sys_practice/code/ch02/data/train.json'
         self.test_json_path = 'recommend_sys_practice/code/ch02/data/test.json'
+        self.cache_path = 'recommend_sys_practice/code/ch02/data/train_test.npz'
         self.file_path = file_path
-        self.users_1000 = self.select_1000_users()
         self.seed = seed
         self.k = k
         self.n_items = n_items
-        self.train, self.test = self.load_and_split_data()
+        self.processes = processes
+        if loader == 'json':
+            self.users_1000 = self.select_1000_users()
+            self.train, self.test = self.load_and_split_data()
+        else:
+            self.train, self.test = self.load_binary_data()
+            self.users_1000 = sorted(set(self.train.keys()) | set(self.test.keys()))
+        # 倒排索引，电影ID -> {用户ID: 评分}，只有评价过同一部电影的用户之间才需要计算相关系数
+        self.item_users = self.build_item_users()
+        # build_neighbors计算好的所有用户的近邻，为None时在recommend中通过倒排索引实时计算
+        self.all_neighbors = None
 
     def select_1000_users(self):
         """
@@ -99,9 +192,94 @@ class FirstRec(object):
 
         return train, test
 
+    def read_selected_ratings(self, n_users=1000, batch_size=256):
+        """
+        多进程遍历一次训练集目录，每个文件只解析一次
+        用户按带种子的哈希值选取哈希值最小的n_users个，子进程解析一批文件后只返回这批文件中哈希值最小的n_users个用户的评分，
+        主进程合并后再选一次，得到的正好是全部用户中哈希值最小的n_users个，主进程不需要持有全部评分
+        @param n_users: 选取的用户数
+        @param batch_size: 每个任务的文件数
+        @return: (用户ID数组, 电影ID数组, 评分数组)，按文件名和文件中的行排列
+        """
+        paths = [os.path.join(self.file_path, file) for file in sorted(os.listdir(self.file_path))]
+        tasks = [(paths[start:start + batch_size], self.seed, n_users) for start in range(0, len(paths), batch_size)]
+        with multiprocessing.Pool(processes=self.processes) as pool:
+            parsed = pool.map(parse_sampled_ratings, tasks)
+
+        if not parsed:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int8)
+        users = np.concatenate([one[0] for one in parsed])
+        movies = np.concatenate([one[1] for one in parsed])
+        rates = np.concatenate([one[2] for one in parsed])
+        keep = np.isin(users, smallest_hash_users(users, self.seed, n_users))
+        return users[keep], movies[keep], rates[keep]
+
+    def load_binary_data(self):
+        """
+        加载训练集和测试集，缓存文件不存在、随机数种子、原始文件路径或用户选取方式不一致时从原始文件生成:
+        子进程解析原始文件时只保留按用户ID哈希选取的用户的评分，再按1/50的概率切分测试集
+        """
+        file_path = os.path.abspath(self.file_path)
+        if os.path.exists(self.cache_path):
+            with np.load(self.cache_path) as cache:
+                if 'sampling' in cache.files and str(cache['sampling']) == USER_SAMPLING \
+                        and str(cache['file_path']) == file_path and int(cache['seed']) == self.seed:
+                    print('从文件中加载训练集和测试集')
+                    train = ratings_to_dict(cache['train_users'], cache['train_movies'], cache['train_rates'])
+                    test = ratings_to_dict(cache['test_users'], cache['test_movies'], cache['test_rates'])
+                    print('从文件中加载数据完成')
+                    return train, test
+
+        print('解析原始文件')
+        users, movies, rates = self.read_selected_ratings()
+
+        rng = np.random.default_rng(self.seed)
+        is_test = rng.integers(1, 51, size=len(users)) == 1
+        arrays = {
+            'sampling': np.asarray(USER_SAMPLING),
+            'seed': np.asarray(self.seed),
+            'file_path': np.asarray(file_path),
+            'train_users': users[~is_test], 'train_movies': movies[~is_test], 'train_rates': rates[~is_test],
+            'test_users': users[is_test], 'test_movies': movies[is_test], 'test_rates': rates[is_test],
+        }
+        # 先写临时文件再替换，避免中断时留下不完整的缓存
+        tmp_path = f'{self.cache_path}.tmp.{os.getpid()}'
+        with open(tmp_path, mode='wb') as fp:
+            np.savez(fp, **arrays)
+        os.replace(tmp_path, self.cache_path)
+        print(f'加载数据到{self.cache_path}')
+
+        train = ratings_to_dict(arrays['train_users'], arrays['train_movies'], arrays['train_rates'])
+        test = ratings_to_dict(arrays['test_users'], arrays['test_movies'], arrays['test_rates'])
+        print('加载数据完成')
+        return train, test
+
+    def build_item_users(self):
+        item_users = dict()
+        for user, ratings in self.train.items():
+            for movie_id, rate in ratings.items():
+                item_users.setdefault(movie_id, {})[user] = rate
+        return item_users
+
+    @staticmethod
+    def pearson_from_sums(num, sum_x, sum_y, sum_xy, sum_x2, sum_y2):
+        """
+        根据共同评分电影上的累加和计算皮尔逊相关系数
+        """
+        if num == 0:
+            return 0
+
+        # 皮尔逊相关系数的分母
+        denominator = math.sqrt(sum_x2 - math.pow(sum_x, 2) / num) * \
+            math.sqrt(sum_y2 - math.pow(sum_y, 2) / num)
+        if denominator == 0:
+            return 0
+        else:
+            return (sum_xy - sum_x * sum_y / num) / denominator
+
     def pearson(self, rating1, rating2):
         """
-        计算皮尔逊相关系数
+        计算皮尔逊相关系数，只在两个用户共同评分的电影上计算
         rating1: 用户1的评分记录，形式如{"movieId1": rate1, "movieId2": rate2}
         rating2: 用户2的评分记录，形式如{"movieId1": rate1, "movieId2": rate2}
         """
@@ -114,41 +292,118 @@ class FirstRec(object):
         sum_x2 = 0
         sum_y2 = 0
         num = 0
-        for key in rating1.keys():
-            for key in rating2.keys():
-                num += 1
-                x = rating1[key]
-                y = rating2[key]
-                sum_xy += x * y
-                sum_x += x
-                sum_y += y
-                sum_x2 += math.pow(x, 2)
-                sum_y2 += math.pow(y, 2)
+        if len(rating1) > len(rating2):
+            common = [key for key in rating2.keys() if key in rating1]
+        else:
+            common = [key for key in rating1.keys() if key in rating2]
+        for key in common:
+            num += 1
+            x = rating1[key]
+            y = rating2[key]
+            sum_xy += x * y
+            sum_x += x
+            sum_y += y
+            sum_x2 += x * x
+            sum_y2 += y * y
 
-        if num == 0:
-            return 0
+        return self.pearson_from_sums(num, sum_x, sum_y, sum_xy, sum_x2, sum_y2)
 
-        # 皮尔逊相关系数的分母
-        denominator = math.sqrt(sum_x2 - math.pow(sum_x, 2) / num) * \
-            math.sqrt(sum_y2 - math.pow(sum_y, 2) / num)
-        if denominator == 0:
-            return 0
-        else:
-            return (sum_xy - sum_x * sum_y / num) / denominator
+    def neighbors(self, user_id):
+        """
+        通过倒排索引计算用户与所有和他有共同评分电影的用户的皮尔逊相关系数
+        只遍历用户评价过的电影的评分用户，复杂度为O(共同评分用户数 x 共同评分电影数)
+        user_id: 用户ID
+        return: [(用户ID, 相关系数)]，按相关系数从大到小排列
+        """
+        if self.all_neighbors is not None:
+            return self.all_neighbors.get(user_id, [])
+
+        # 每个共同评分用户的累加和: [num, sum_x, sum_y, sum_xy, sum_x2, sum_y2]
+        sums = dict()
+        for movie_id, x in self.train.get(user_id, {}).items():
+            for user, y in self.item_users.get(movie_id, {}).items():
+                if user == user_id:
+                    continue
+                one = sums.get(user)
+                if one is None:
+                    one = sums[user] = [0, 0, 0, 0, 0, 0]
+                one[0] += 1
+                one[1] += x
+                one[2] += y
+                one[3] += x * y
+                one[4] += x * x
+                one[5] += y * y
+
+        neighbor_user = {user: self.pearson_from_sums(*one) for user, one in sums.items()}
+        return sorted(neighbor_user.items(), key=lambda k: k[1], reverse=True)
+
+    def pearson_matrix(self):
+        """
+        向量化计算所有用户两两之间在共同评分电影上的皮尔逊相关系数
+        B为评分与否的0/1矩阵，X为评分矩阵，共同评分电影上的各个累加和都是稀疏矩阵乘积:
+            num = B·B^T，sum_x = X·B^T，sum_y = sum_x^T，sum_xy = X·X^T，sum_x2 = X²·B^T，sum_y2 = sum_x2^T
+        return: (users, 相关系数矩阵(CSR))，只保存有共同评分电影的用户对，不含对角线
+        """
+        users = list(self.train.keys())
+        movie_index = {movie_id: col for col, movie_id in enumerate(self.item_users.keys())}
+        rows, cols, data = [], [], []
+        for row, user in enumerate(users):
+            for movie_id, rate in self.train[user].items():
+                rows.append(row)
+                cols.append(movie_index[movie_id])
+                data.append(rate)
+
+        shape = (len(users), len(movie_index))
+        x = sp.csr_matrix((np.asarray(data, dtype=np.float64), (rows, cols)), shape=shape)
+        b = x.copy()
+        b.data[:] = 1
+        x2 = x.multiply(x).tocsr()
+
+        def canonical(matrix):
+            matrix = matrix.tocsr()
+            matrix.sort_indices()
+            return matrix
+
+        # 评分都不为0，所以这些矩阵的稀疏结构都与num相同，可以直接按data逐项计算
+        num = canonical(b @ b.T)
+        sum_x = canonical(x @ b.T)
+        sum_y = canonical(sum_x.T)
+        sum_xy = canonical(x @ x.T)
+        sum_x2 = canonical(x2 @ b.T)
+        sum_y2 = canonical(sum_x2.T)
+
+        n = num.data
+        numerator = sum_xy.data - sum_x.data * sum_y.data / n
+        denominator = np.sqrt(np.maximum(sum_x2.data - sum_x.data ** 2 / n, 0)) * \
+            np.sqrt(np.maximum(sum_y2.data - sum_y.data ** 2 / n, 0))
+        sim = np.zeros(len(n))
+        np.divide(numerator, denominator, out=sim, where=denominator > 0)
+
+        # 去掉对角线，相关系数为0的用户对保留，与neighbors的结果一致
+        rows = np.repeat(np.arange(num.shape[0]), np.diff(num.indptr))
+        keep = rows != num.indices
+        result = sp.csr_matrix((sim[keep], (rows[keep], num.indices[keep])), shape=num.shape)
+        return users, result
+
+    def build_neighbors(self):
+        """
+        用pearson_matrix一次算出所有用户的近邻，之后recommend直接使用
+        """
+        users, sim = self.pearson_matrix()
+        self.all_neighbors = dict()
+        for row, user in enumerate(users):
+            start, end = sim.indptr[row], sim.indptr[row + 1]
+            related = [(users[col], weight) for col, weight in
+                       zip(sim.indices[start:end].tolist(), sim.data[start:end].tolist())]
+            self.all_neighbors[user] = sorted(related, key=lambda k: k[1], reverse=True)
 
     def recommend(self, user_id):
         """
         对用户进行电影推荐
         user_id: 用户ID
         """
-        neighborUser = dict()
-        for user in self.train.keys():
-            if user_id != user:
-                distance = self.pearson(self.train[user_id], self.train[user])
-                neighborUser[user] = distance
-
-        # 字典排序，按distance进行排序
-        newNU = sorted(neighborUser.items(), key=lambda k: k[1], reversed=True)
+        # 按distance排序的近邻
+        newNU = self.neighbors(user_id)
 
         movies = dict()
         for (sim_user, sim) in newNU[: self.k]:
@@ -156,7 +411,7 @@ class FirstRec(object):
                 movies.setdefault(movie_id, 0)
                 movies[movie_id] += sim * self.train[sim_user][movie_id]
 
-        newMovies = sorted(movies.items(), key=lambda k: k[1], reversed=True)
+        newMovies = sorted(movies.items(), key=lambda k: k[1], reverse=True)
 
         return newMovies
 
@@ -169,7 +424,7 @@ class FirstRec(object):
         print('开始计算准确率')
         precisions = list()
         random.seed(10)
-        for user_id in random.sample(self.test.keys(), num):
+        for user_id in random.sample(list(self.test.keys()), num):
             hit = 0
             result = self.recommend(user_id=user_id)[: self.n_items]
             for (item, rate) in result:
@@ -10,6 +10,164 @@
 '''
 
 # here put the import lib
+import contextlib
+import multiprocessing
+
+import numpy as np
+
+from transactions import ListSource
+
+# 每个字节中1的个数，numpy没有bitwise_count时用于计算popcount
+_BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# 计算支持度时每一块候选项集的位图最多占用的字节数，内存占用与候选项集个数无关
+COUNT_BLOCK_BYTES = 16 * 1024 * 1024
+
+
+def popcount(words):
+    """
+    按行统计uint64位图中1的个数
+    :param words: (n, 字数)的uint64数组
+    :return: 长度为n的int64数组
+    """
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=1, dtype=np.int64)
+    return _BYTE_POPCOUNT[words.view(np.uint8)].sum(axis=1, dtype=np.int64)
+
+
+def first_set_bit(words):
+    """
+    每行位图中最低的为1的位的位置，即第一个包含该项集的事务编号，全为0的行返回-1
+    """
+    nonzero = words != 0
+    first_word = np.argmax(nonzero, axis=1)
+    word = words[np.arange(len(words)), first_word]
+    lowest = word & (~word + np.uint64(1))
+    bit = np.log2(np.maximum(lowest, 1).astype(np.float64)).astype(np.int64)
+    return np.where(nonzero.any(axis=1), first_word * 64 + bit, -1)
+
+
+class VerticalData(object):
+    """
+    事务数据的纵向表示: 第t条事务包含某个项时，该项位图中第t位为1，每64条事务打包为一个uint64
+    先统计每个项的出现次数，只为满足最小支持度且在items中的项构建位图，位图占用的内存与不频繁的长尾项无关
+    """
+
+    def __init__(self, data, min_support=0.0, items=None):
+        """
+        :param data: 事务列表
+        :param min_support: 构建位图的项的最小支持度，不满足的项只记录出现次数
+        :param items: 构建位图的项的集合，为None时不限制
+        """
+        super().__init__()
+        self.data = data
+        # 项 -> 编号，包含数据中的全部项
+        self.item_index = {}
+        rows, tids = [], []
+        for tid, items_of_tid in enumerate(data):
+            for item in set(items_of_tid):
+                rows.append(self.item_index.setdefault(item, len(self.item_index)))
+                tids.append(tid)
+        rows = np.asarray(rows, dtype=np.int64)
+        tids = np.asarray(tids, dtype=np.int64)
+
+        # 每个项的出现次数和第一个包含该项的事务编号，事务编号是递增的，第一次出现的位置即最小的编号
+        self.item_counts = np.bincount(rows, minlength=len(self.item_index))
+        self.item_first_tids = np.full(len(self.item_index), -1, dtype=np.int64)
+        distinct, first = np.unique(rows, return_index=True)
+        self.item_first_tids[distinct] = tids[first]
+
+        # 项的编号 -> 位图的行号，没有位图的项为-1
+        keep = self.item_counts * 1.0 / max(len(data), 1) >= min_support
+        if items is not None:
+            keep &= np.asarray([item in items for item in self.item_index], dtype=bool)
+        self.bitmap_rows = np.full(len(self.item_index), -1, dtype=np.int64)
+        self.bitmap_rows[keep] = np.arange(int(keep.sum()))
+
+        n_words = (len(data) + 63) // 64
+        self.bitmaps = np.zeros((int(keep.sum()), n_words), dtype=np.uint64)
+        in_bitmap = keep[rows]
+        rows, tids = self.bitmap_rows[rows[in_bitmap]], tids[in_bitmap]
+        bits = np.left_shift(np.uint64(1), (tids & 63).astype(np.uint64))
+        np.bitwise_or.at(self.bitmaps, (rows, tids >> 6), bits)
+
+    def count(self, ck, block_bytes=COUNT_BLOCK_BYTES):
+        """
+        计算候选项集的出现次数
+        只包含一个项的项集直接取该项的出现次数，包含多个项时，含有没有位图的项的项集出现次数按0计算，
+        因此只能对由频繁项(以及items中的项)组成的候选项集调用
+        :param ck: 候选项集列表
+        :param block_bytes: 每一块候选项集的位图最多占用的字节数
+        :return: (出现次数数组, 第一个包含该项集的事务编号数组)，与ck一一对应，不出现时编号为-1
+        """
+        counts = np.zeros(len(ck), dtype=np.int64)
+        first_tids = np.full(len(ck), -1, dtype=np.int64)
+        # 按项集大小分组，同一组的位图可以堆叠在一起计算
+        groups = {}
+        for position, one in enumerate(ck):
+            rows = [self.item_index.get(item) for item in one]
+            # 包含数据中不存在的项的项集出现次数为0
+            if len(rows) == 1 and rows[0] is not None:
+                counts[position] = self.item_counts[rows[0]]
+                first_tids[position] = self.item_first_tids[rows[0]]
+            elif len(rows) > 1 and None not in rows:
+                rows = self.bitmap_rows[rows].tolist()
+                if -1 not in rows:
+                    groups.setdefault(len(rows), ([], []))
+                    groups[len(rows)][0].append(position)
+                    groups[len(rows)][1].append(rows)
+
+        # 按块处理候选项集，每块逐列按位与到同一个缓冲区中，统计完再处理下一块
+        block = max(1, block_bytes // max(1, self.bitmaps.shape[1] * self.bitmaps.itemsize))
+        for positions, rows in groups.values():
+            positions = np.asarray(positions, dtype=np.int64)
+            rows = np.asarray(rows, dtype=np.int64)
+            for start in range(0, len(positions), block):
+                block_rows = rows[start:start + block]
+                words = self.bitmaps[block_rows[:, 0]]
+                for column in range(1, block_rows.shape[1]):
+                    np.bitwise_and(words, self.bitmaps[block_rows[:, column]], out=words)
+                counts[positions[start:start + block]] = popcount(words)
+                first_tids[positions[start:start + block]] = first_set_bit(words)
+
+        return counts, first_tids
+
+
+# 子进程通过fork继承的数据，只读，避免每个任务都序列化一次位图或支持度
+_vertical = None
+_miner = None
+_itemsets = None
+_support_data = None
+
+# 候选项集少于该个数时在当前进程中计算，避免为很少的计算付出进程间传输的开销
+PARALLEL_MIN_CANDIDATES = 10000
+
+
+def _count_candidates(ck):
+    """
+    在fork继承的全部事务位图上计算一批候选项集的出现次数
+    :param ck: 候选项集列表
+    :return: (出现次数数组, 第一个包含该项集的事务编号数组)
+    """
+    return _vertical.count(ck)
+
+
+def _rules_of_itemsets(task):
+    """
+    生成一批频繁项集的相关规则，子进程中不输出规则，由主进程按顺序输出
+    项集通过fork继承而不是序列化传入，保证项集中元素的遍历顺序与主进程相同，规则的顺序与单进程一致
+    :param task: (起始下标, 结束下标)
+    """
+    start, end = task
+    _miner.print_rules = False
+    rules = []
+    for ck in _itemsets[start:end]:
+        _miner.rules_of_more(ck, [frozenset([item]) for item in ck], _support_data, rules)
+    return rules
+
+
+def can_fork(processes):
+    return processes != 1 and 'fork' in multiprocessing.get_all_start_methods()
 
 
 class Apriori(object):
@@ -17,18 +175,35 @@ class Apriori(object):
     基于APriori算法实现频繁项集合相关规则挖掘
     """
 
-    def __init__(self, min_support, min_confidence):
+    def __init__(self, min_support, min_confidence, source=None, processes=1):
+        """
+        :param min_support: 最小支持度
+        :param min_confidence: 最小置信度
+        :param source: 事务数据来源(TransactionSource或事务列表)，为None时使用内置的示例数据
+        :param processes: 计算支持度和生成相关规则的进程数，为None时使用全部CPU，不支持fork的平台上在当前进程中计算
+        """
         super().__init__()
         # 最小支持度
         self.min_support = min_support
         # 最小置信度
         self.min_confidence = min_confidence
-        self.data = self.load_data()
+        self.source = ListSource(source) if isinstance(source, list) else source
+        # 指定了数据来源时，只在需要全部数据时才加载到内存中，分块挖掘(genenrate_lk_son)不加载
+        self.data = self.load_data() if source is None else None
+        # 纵向表示，第一次计算支持度时根据self.data构建，多进程时由子进程通过fork继承
+        self.vertical = None
+        self.processes = processes
+        # genenrate_lk期间各层共用的进程池
+        self.pool = None
+        # 生成相关规则时是否输出每条规则
+        self.print_rules = True
 
     def load_data(self):
         """
         加载数据集
         """
+        if self.source is not None:
+            return [basket for chunk in self.source.chunks() for basket in chunk]
         return [[1, 5], [2, 3, 4], [2, 3, 4, 5], [2, 3]]
 
     def create_c1(self, data):
@@ -36,12 +211,8 @@ class Apriori(object):
         生成项集C1，不包含相机中每个元素出现的次数
         :return:
         """
-        # c1为大小为1的项的集合
-        c1 = list()
-        for items in data:
-            for item in items:
-                if [item] not in c1:
-                    c1.append([item])
+        # c1为大小为1的项的集合，用集合去重，与在列表中逐个查找的结果相同
+        c1 = sorted([item] for item in set(item for items in data for item in items))
 
         # map函数表示遍历c1中的每个元素执行frozenset
         # frozenset表示“冰冻”集合，即不可改变
@@ -60,21 +231,22 @@ class Apriori(object):
     def scand(self, ck):
         """
         该函数用于从候选集ck生成lk，lk表示满足最低支持度的元素集合
+        项集的出现次数为其中各项位图按位与之后1的个数，每一层的候选项集一次向量化计算
         :param ck:
         :return:
         """
-        # data表示数据列表的列表，[set([]), set([]), set([]), set([])]
-        data = list(map(set, self.data))
+        counts, first_tids = self.count_support(ck)
+
+        # 与逐条事务扫描时的顺序一致: 按第一个包含该项集的事务排序，同一事务中按候选项集的顺序
         ck_count = {}
-        for items in data:
-            for one in ck:
-                # issubset: 表示如果集合one中的每一个元素都在items中，则返回true
-                if one.issubset(items):
-                    ck_count.setdefault(one, 0)
-                    ck_count[one] += 1
+        positions = np.flatnonzero(counts > 0).tolist()
+        for position in sorted(positions, key=lambda one: (first_tids[one], one)):
+            one = ck[position]
+            ck_count.setdefault(one, 0)
+            ck_count[one] += int(counts[position])
 
         # 数据条数
-        num_items = len(list(data))
+        num_items = len(self.data)
         # 初始化符合支持度的项集
         lk = []
         # 初始化所有符合条件的项集及对应的支持度
@@ -90,6 +262,55 @@ class Apriori(object):
 
         return lk, support_data
 
+    def count_support(self, ck):
+        """
+        计算候选项集在self.data中的出现次数
+        多进程时把候选项集按顺序切分为与进程数相同的批次，每个候选项集只传给一个进程，
+        各进程在fork继承的全部事务位图上计算，结果按原来的顺序拼接
+        :param ck: 候选项集列表
+        :return: (出现次数数组, 第一个包含该项集的事务编号数组)
+        """
+        if self.vertical is None or self.vertical.data is not self.data:
+            self.vertical = VerticalData(self.data, min_support=self.min_support)
+        if not can_fork(self.processes) or len(ck) < PARALLEL_MIN_CANDIDATES:
+            return self.vertical.count(ck)
+
+        if self.pool is None:
+            # 不在genenrate_lk中调用时临时创建进程池
+            with self.counting_pool():
+                return self.count_support(ck)
+
+        n_batches = self.processes or multiprocessing.cpu_count()
+        size = (len(ck) + n_batches - 1) // n_batches
+        batches = [ck[start:start + size] for start in range(0, len(ck), size)]
+        results = self.pool.map(_count_candidates, batches)
+
+        counts = np.concatenate([batch_counts for batch_counts, _ in results])
+        first_tids = np.concatenate([batch_first for _, batch_first in results])
+        return counts, first_tids
+
+    @contextlib.contextmanager
+    def counting_pool(self):
+        """
+        多进程时先构建全部事务的位图，再创建进程池，子进程通过fork继承位图，各层的候选项集都交给同一个进程池计算
+        """
+        global _vertical
+        if not can_fork(self.processes) or self.pool is not None:
+            yield
+            return
+
+        if self.vertical is None or self.vertical.data is not self.data:
+            self.vertical = VerticalData(self.data, min_support=self.min_support)
+
+        _vertical = self.vertical
+        try:
+            with multiprocessing.get_context('fork').Pool(processes=self.processes) as pool:
+                self.pool = pool
+                yield
+        finally:
+            self.pool = None
+            _vertical = None
+
     def generate_new_ck(self, lk, k):
         """
 
@@ -97,33 +318,90 @@ class Apriori(object):
         :param k: 项集元素个数
         :return: ck
         """
-        next_lk = []
-        len_lk = len(lk)
         # 若两个项集的长度为k-1，则必须前k-2项相同才可连接，即求并集，所以[:k-2]的实际作用为取列表的前k-1个元素
-        for i in range(len_lk):
-            for j in range(i+1, len_lk):
-                # 前k-2项相同时合并两个集合
-                l1 = list(lk[i])[: k-2]
-                l2 = list(lk[j])[: k-2]
-                if sorted(l1) == sorted(l2):
+        # 按前k-2项分组，只在同一组内两两合并，不再比较所有的项集对
+        prefixes = [tuple(sorted(list(one)[: k-2])) for one in lk]
+        groups = {}
+        for i, prefix in enumerate(prefixes):
+            groups.setdefault(prefix, []).append(i)
+
+        next_lk = []
+        for i, prefix in enumerate(prefixes):
+            # 前k-2项相同时合并两个集合，顺序与逐对比较时相同
+            for j in groups[prefix]:
+                if j > i:
                     next_lk.append(lk[i] | lk[j])
 
         return next_lk
 
     # 生成频繁项集
     def genenrate_lk(self):
-        # 构建候选项集c1
-        c1 = self.create_c1(self.data)
-        l1, support_data = self.scand(c1)
-        l = [l1]
-        k = 2
-        while len(l[k-2]) > 0:
-            # 组合项集lk中元素，生成新的候选项集ck
-            ck = self.generate_new_ck(l[k-2], k)
-            lk, support_k = self.scand(ck)
-            support_data.update(support_k)
-            l.append(lk)
-            k += 1
+        if self.data is None:
+            self.data = self.load_data()
+        with self.counting_pool():
+            # 构建候选项集c1
+            c1 = self.create_c1(self.data)
+            l1, support_data = self.scand(c1)
+            l = [l1]
+            k = 2
+            while len(l[k-2]) > 0:
+                # 组合项集lk中元素，生成新的候选项集ck
+                ck = self.generate_new_ck(l[k-2], k)
+                lk, support_k = self.scand(ck)
+                support_data.update(support_k)
+                l.append(lk)
+                k += 1
+
+        return l, support_data
+
+    # 分块生成频繁项集
+    def genenrate_lk_son(self, chunk_size=100000, local_miner=None):
+        """
+        SON算法，数据不需要一次放入内存，只遍历两次数据来源:
+        1. 对每一块数据按相同的最小支持度(比例)挖掘局部频繁项集，全局频繁的项集至少在一块中局部频繁，所有局部频繁项集的并集为候选项集
+        2. 再遍历一次数据，统计每个候选项集在全部数据中的出现次数，过滤掉不满足最小支持度的项集，
+           每块只为候选项集中的项构建位图
+        :param chunk_size: 每块的事务条数，需要能放入内存
+        :param local_miner: 挖掘局部频繁项集的类(Apriori或FPGrowth)，为None时与当前类相同
+        :return: 与genenrate_lk相同
+        """
+        local_miner = local_miner or type(self)
+        # 没有指定数据来源时对内置的示例数据分块
+        source = self.source if self.source is not None else ListSource(self.data)
+        candidates = set()
+        for chunk in source.chunks(chunk_size):
+            local = local_miner(self.min_support, self.min_confidence, source=chunk)
+            local_l, _ = local.genenrate_lk()
+            for lk in local_l:
+                candidates.update(lk)
+        candidates = sorted(candidates, key=lambda one: (len(one), sorted(one)))
+
+        # 只包含一个项的候选项集直接取该项的出现次数，不需要位图
+        candidate_items = set(item for one in candidates if len(one) > 1 for item in one)
+        counts = np.zeros(len(candidates), dtype=np.int64)
+        num_items = 0
+        for chunk in source.chunks(chunk_size):
+            counts += VerticalData(chunk, items=candidate_items).count(candidates)[0]
+            num_items += len(chunk)
+
+        return self.levels_from_counts(candidates, counts, num_items)
+
+    def levels_from_counts(self, candidates, counts, num_items):
+        """
+        根据候选项集的出现次数整理为genenrate_lk的返回形式
+        :return: (l, support_data)，l[k-1]为包含k个元素的频繁项集，最后一层为空列表
+        """
+        support_data = {}
+        l = [[]]
+        for one, count in zip(candidates, counts.tolist()):
+            if count == 0:
+                continue
+            support = count * 1.0 / num_items
+            support_data[one] = support
+            if support >= self.min_support:
+                while len(l) <= len(one):
+                    l.append([])
+                l[len(one) - 1].append(one)
 
         return l, support_data
 
@@ -140,14 +418,32 @@ class Apriori(object):
         :param support_data:
         :return:
         """
-        # 最终记录的相关规则结果
-        rule_result = []
-        for i in range(1, len(l)):
-            for ck in l[i]:
+        global _miner, _itemsets, _support_data
+        itemsets = [ck for i in range(1, len(l)) for ck in l[i]]
+        if not can_fork(self.processes) or len(itemsets) < 2:
+            # 最终记录的相关规则结果
+            rule_result = []
+            for ck in itemsets:
                 cks = [frozenset([item]) for item in ck]
                 # 频繁项集中有三个及三个以上元素的集合
                 self.rules_of_more(ck, cks, support_data, rule_result)
+            return rule_result
+
+        # 按频繁项集分批并行生成，结果按原来的顺序拼接
+        n_batches = min(4 * (self.processes or multiprocessing.cpu_count()), len(itemsets))
+        size = (len(itemsets) + n_batches - 1) // n_batches
+        _miner, _itemsets, _support_data = self, itemsets, support_data
+        try:
+            with multiprocessing.get_context('fork').Pool(processes=self.processes) as pool:
+                ranges = [(start, start + size) for start in range(0, len(itemsets), size)]
+                results = pool.map(_rules_of_itemsets, ranges)
+        finally:
+            _miner, _itemsets, _support_data = None, None, None
 
+        rule_result = [rule for rules in results for rule in rules]
+        if self.print_rules:
+            for antecedent, consequent, conf in rule_result:
+                print(antecedent, "-->", consequent, "confidence is: ", conf)
         return rule_result
 
     def rules_of_two(self, ck, cks, support_data, rules_result):
@@ -164,7 +460,8 @@ class Apriori(object):
             # 计算置信度
             conf = support_data[ck] / support_data[ck - one_ck]
             if conf >= self.min_confidence:
-                print(ck - one_ck, "-->", one_ck, "confidence is: ", conf)
+                if self.print_rules:
+                    print(ck - one_ck, "-->", one_ck, "confidence is: ", conf)
                 rules_result.append((ck - one_ck, one_ck, conf))
                 pruned_h.append(one_ck)
 
@@ -189,6 +486,124 @@ class Apriori(object):
                 break
 
 
+class FPNode(object):
+    """
+    FP树的节点
+    """
+
+    def __init__(self, item, parent):
+        super().__init__()
+        self.item = item
+        self.count = 0
+        self.parent = parent
+        self.children = {}
+
+
+class FPTree(object):
+    """
+    FP树，只包含满足最小支持度的项，每条事务中的项按出现次数从多到少插入，
+    header记录每个项在树中的所有节点，用于取出条件模式基
+    """
+
+    def __init__(self, transactions, is_frequent):
+        """
+        :param transactions: [(项列表, 出现次数)]
+        :param is_frequent: 判断出现次数是否满足最小支持度的函数
+        """
+        super().__init__()
+        counts = {}
+        for items, count in transactions:
+            for item in items:
+                counts[item] = counts.get(item, 0) + count
+
+        # 出现次数相同的项按第一次出现的顺序排列，保证每次构建的树相同
+        self.counts = {item: count for item, count in counts.items() if is_frequent(count)}
+        order = sorted(self.counts.keys(), key=lambda item: -self.counts[item])
+        self.rank = {item: r for r, item in enumerate(order)}
+        self.root = FPNode(None, None)
+        self.header = {item: [] for item in order}
+        for items, count in transactions:
+            path = sorted((item for item in set(items) if item in self.rank),
+                          key=lambda item: self.rank[item])
+            self.insert(path, count)
+
+    def insert(self, path, count):
+        node = self.root
+        for item in path:
+            child = node.children.get(item)
+            if child is None:
+                child = node.children[item] = FPNode(item, node)
+                self.header[item].append(child)
+            child.count += count
+            node = child
+
+    def prefix_paths(self, item):
+        """
+        条件模式基: item的每个节点到根节点的路径(不含item本身)及该节点的次数
+        :param item:
+        :return: [(项列表, 出现次数)]
+        """
+        paths = []
+        for node in self.header[item]:
+            path = []
+            parent = node.parent
+            while parent.item is not None:
+                path.append(parent.item)
+                parent = parent.parent
+            if path:
+                paths.append((path, node.count))
+        return paths
+
+
+class FPGrowth(Apriori):
+    """
+    基于FP-Growth算法实现频繁项集挖掘，只扫描两次数据构建FP树，不需要逐层生成候选项集
+    最小支持度、最小置信度以及genenrate_lk和genenrate_rules的返回结果与Apriori相同，可以直接替换
+    """
+
+    def mine(self, tree, suffix, is_frequent, support_counts):
+        """
+        从出现次数最少的项开始，递归挖掘以suffix结尾的频繁项集
+        :param tree: 条件FP树
+        :param suffix: 当前后缀项集
+        :param is_frequent: 判断出现次数是否满足最小支持度的函数
+        :param support_counts: 结果，频繁项集 -> 出现次数
+        :return:
+        """
+        for item in sorted(tree.counts.keys(), key=lambda one: -tree.rank[one]):
+            itemset = suffix | frozenset([item])
+            support_counts[itemset] = tree.counts[item]
+            conditional = FPTree(tree.prefix_paths(item), is_frequent)
+            if conditional.counts:
+                self.mine(conditional, itemset, is_frequent, support_counts)
+
+    # 生成频繁项集
+    def genenrate_lk(self):
+        if self.data is None:
+            self.data = self.load_data()
+        num_items = len(self.data)
+
+        def is_frequent(count):
+            return count * 1.0 / num_items >= self.min_support
+
+        support_counts = {}
+        if num_items > 0:
+            tree = FPTree([(items, 1) for items in self.data], is_frequent)
+            self.mine(tree, frozenset(), is_frequent, support_counts)
+
+        # 与Apriori相同，l[k-1]为包含k个元素的频繁项集，最后一层为空列表
+        max_size = max((len(one) for one in support_counts), default=0)
+        l = [[] for _ in range(max_size + 1)]
+        for itemset in support_counts:
+            l[len(itemset) - 1].append(itemset)
+        for lk in l:
+            lk.sort(key=sorted)
+        support_data = {itemset: count * 1.0 / num_items
+                        for itemset, count in support_counts.items()}
+
+        return l, support_data
+
+
 if __name__ == '__main__':
     apriori = Apriori(min_support=0.5, min_confidence=0.6)
     l, support_data = apriori.genenrate_lk()
@@ -198,3 +613,18 @@ if __name__ == '__main__':
     print(f'support data: {support_data}')
     print(f'min_conf=0.6时:')
     rules = apriori.genenrate_rules(l, support_data)
+
+    fp_growth = FPGrowth(min_support=0.5, min_confidence=0.6)
+    fp_l, fp_support_data = fp_growth.genenrate_lk()
+    for one in fp_l:
+        print(f'FP-Growth 项数为 {fp_l.index(one) + 1} 的频繁项集：{one}')
+
+    son_apriori = Apriori(min_support=0.5, min_confidence=0.6)
+    son_l, son_support_data = son_apriori.genenrate_lk_son(chunk_size=2)
+    print(f'SON 频繁项集：{son_l}')
+
+    # 按订单分块挖掘retailrocket的购买记录
+    # from transactions import RetailrocketSource
+    # with RetailrocketSource('../../data/retailrocket/events.csv', key='transactionid') as source:
+    #     fp_son = FPGrowth(min_support=0.0005, min_confidence=0.1, source=source)
+    #     son_l, son_support_data = fp_son.genenrate_lk_son()
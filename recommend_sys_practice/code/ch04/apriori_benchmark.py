@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+'''
+@File    :   apriori_benchmark.py
+@Version :   1.0
+@Desc    :   对比不同进程数下Apriori计算支持度和生成相关规则的耗时
+'''
+
+# here put the import lib
+import sys
+import time
+import multiprocessing
+
+from apriori import Apriori
+from transactions import RetailrocketSource
+
+
+def mine_levels(apriori):
+    """
+    与Apriori.genenrate_lk相同的逐层挖掘，分别统计生成候选项集和计算支持度的耗时
+    :param apriori: Apriori对象
+    :return: (l, support_data, 生成候选项集耗时, 计算支持度耗时)
+    """
+    apriori.data = apriori.load_data()
+    gen_elapsed, count_elapsed = 0.0, 0.0
+    with apriori.counting_pool():
+        start = time.time()
+        c1 = apriori.create_c1(apriori.data)
+        gen_elapsed += time.time() - start
+        start = time.time()
+        l1, support_data = apriori.scand(c1)
+        count_elapsed += time.time() - start
+        l = [l1]
+        k = 2
+        while len(l[k-2]) > 0:
+            start = time.time()
+            ck = apriori.generate_new_ck(l[k-2], k)
+            gen_elapsed += time.time() - start
+            start = time.time()
+            lk, support_k = apriori.scand(ck)
+            count_elapsed += time.time() - start
+            support_data.update(support_k)
+            l.append(lk)
+            k += 1
+
+    return l, support_data, gen_elapsed, count_elapsed
+
+
+def benchmark_processes(data, min_support, min_confidence, process_counts):
+    """
+    生成候选项集在主进程中串行执行，与进程数无关，单独计时，只有计算支持度和生成相关规则会并行
+    :param data: 事务列表
+    :param min_support: 最小支持度
+    :param min_confidence: 最小置信度
+    :param process_counts: 进程数列表
+    :return: [(进程数, 生成候选项集耗时, 计算支持度耗时, 相关规则耗时, 频繁项集个数, 规则条数)]
+    """
+    result = []
+    for processes in process_counts:
+        apriori = Apriori(min_support, min_confidence, source=data, processes=processes)
+        l, support_data, gen_elapsed, count_elapsed = mine_levels(apriori)
+
+        apriori.print_rules = False
+        start = time.time()
+        rules = apriori.genenrate_rules(l, support_data)
+        rules_elapsed = time.time() - start
+        result.append((processes, gen_elapsed, count_elapsed, rules_elapsed,
+                       sum(len(lk) for lk in l), len(rules)))
+
+    return result
+
+
+if __name__ == '__main__':
+    # 用法: python apriori_benchmark.py [events.csv路径] [最小支持度] [最小置信度]
+    path = sys.argv[1] if len(sys.argv) > 1 else '../../data/retailrocket/events.csv'
+    min_support = float(sys.argv[2]) if len(sys.argv) > 2 else 0.01
+    min_confidence = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+    # 按访客分组的购买和加购记录，事务条数比按订单分组多，计算量更适合比较
+    with RetailrocketSource(path, key='visitorid', events=('addtocart', 'transaction')) as source:
+        baskets = [basket for basket in source if len(basket) > 1]
+
+    cpu_count = multiprocessing.cpu_count()
+    process_counts = sorted({1, 2, 4, cpu_count} & set(range(1, cpu_count + 1)))
+    rows = benchmark_processes(baskets, min_support, min_confidence, process_counts)
+    print(f'事务条数: {len(baskets)}, min_support: {min_support}, min_confidence: {min_confidence}')
+    # speedup只比较会并行的计算支持度和生成相关规则两部分
+    print('processes  gen(s)  count(s)  rules(s)  speedup  itemsets  rules')
+    base = rows[0][2] + rows[0][3]
+    for processes, gen_elapsed, count_elapsed, rules_elapsed, n_itemsets, n_rules in rows:
+        speedup = base / max(count_elapsed + rules_elapsed, 1e-9)
+        print(f'{processes:9d} {gen_elapsed:7.2f} {count_elapsed:9.2f} {rules_elapsed:9.2f} {speedup:8.2f} '
+              f'{n_itemsets:9d} {n_rules:6d}')
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+'''
+@File    :   rule_recommender.py
+@Version :   1.0
+@Desc    :   基于相关规则的"购买了还购买"推荐
+'''
+
+# here put the import lib
+import heapq
+import time
+
+
+class AlsoBoughtRecommender(object):
+    """
+    把相关规则编译为按前件索引的结构:
+        rules_by_antecedent: 前件 -> [(后件, 置信度, 提升度)]，按排序指标从大到小排列
+        item_antecedents: 项 -> 包含该项的前件编号列表，用于找出被购物篮包含的前件
+    查询时只遍历购物篮中各项的前件列表，前件中的每一项都在购物篮中时规则才匹配
+    """
+
+    def __init__(self, rules, support_data, sort_by='confidence'):
+        """
+        :param rules: genenrate_rules的结果，[(前件, 后件, 置信度)]
+        :param support_data: genenrate_lk得到的支持度，用于计算提升度
+        :param sort_by: 排序指标，confidence或lift
+        """
+        super().__init__()
+        if sort_by not in ('confidence', 'lift'):
+            raise ValueError(f'不支持的排序指标: {sort_by}')
+        self.sort_by = sort_by
+        self.rules_by_antecedent = {}
+        for antecedent, consequent, conf in rules:
+            # 提升度 = 置信度 / 后件的支持度
+            lift = conf / support_data[consequent] if support_data.get(consequent) else 0.0
+            self.rules_by_antecedent.setdefault(antecedent, []).append((consequent, conf, lift))
+
+        score = (lambda rule: (rule[1], rule[2])) if sort_by == 'confidence' else (lambda rule: (rule[2], rule[1]))
+        self.antecedents = list(self.rules_by_antecedent.keys())
+        self.item_antecedents = {}
+        for index, antecedent in enumerate(self.antecedents):
+            self.rules_by_antecedent[antecedent].sort(key=score, reverse=True)
+            for item in antecedent:
+                self.item_antecedents.setdefault(item, []).append(index)
+
+    @classmethod
+    def from_miner(cls, miner, sort_by='confidence'):
+        """
+        用Apriori或FPGrowth挖掘相关规则并构建推荐器
+        :param miner: Apriori或FPGrowth
+        :param sort_by: 排序指标，confidence或lift
+        :return:
+        """
+        l, support_data = miner.genenrate_lk()
+        miner.print_rules = False
+        return cls(miner.genenrate_rules(l, support_data), support_data, sort_by=sort_by)
+
+    def matching_antecedents(self, basket):
+        """
+        找出所有被购物篮包含的前件
+        :param basket: 购物篮中的项
+        :return: 前件列表
+        """
+        hits = {}
+        for item in set(basket):
+            for index in self.item_antecedents.get(item, ()):
+                hits[index] = hits.get(index, 0) + 1
+
+        return [self.antecedents[index] for index, hit in hits.items() if hit == len(self.antecedents[index])]
+
+    def recommend(self, basket, n=10):
+        """
+        为购物篮推荐n个项，每个项取所有匹配规则中排序指标最高的一条
+        :param basket: 购物篮中的项
+        :param n: 推荐个数
+        :return: [(项, 置信度, 提升度)]，按排序指标从大到小排列，不包含购物篮中已有的项
+        """
+        basket = set(basket)
+        best = {}
+        for antecedent in self.matching_antecedents(basket):
+            for consequent, conf, lift in self.rules_by_antecedent[antecedent]:
+                for item in consequent:
+                    if item in basket:
+                        continue
+                    score = (conf, lift) if self.sort_by == 'confidence' else (lift, conf)
+                    if item not in best or score > best[item][0]:
+                        best[item] = (score, conf, lift)
+
+        top = heapq.nlargest(n, best.items(), key=lambda one: one[1][0])
+        return [(item, conf, lift) for item, (_, conf, lift) in top]
+
+
+if __name__ == '__main__':
+    from apriori import Apriori
+
+    recommender = AlsoBoughtRecommender.from_miner(Apriori(min_support=0.5, min_confidence=0.6))
+    basket = [3]
+    start = time.time()
+    result = recommender.recommend(basket, n=5)
+    print(f'购物篮 {basket} 的推荐结果：{result}，耗时 {(time.time() - start) * 1000:.3f} ms')
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+'''
+@File    :   transactions.py
+@Version :   1.0
+@Desc    :   频繁项集挖掘的事务数据来源，支持按块流式读取不能一次放入内存的数据
+'''
+
+# here put the import lib
+import abc
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+class TransactionSource(abc.ABC):
+    """
+    事务数据来源，chunks按块返回事务(每条事务为项的列表)，可以多次遍历
+    子类必须实现chunks
+    """
+
+    @abc.abstractmethod
+    def chunks(self, chunk_size=100000):
+        """
+        :param chunk_size: 每块的事务条数
+        :return: 生成事务列表
+        """
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            for basket in chunk:
+                yield basket
+
+    def close(self):
+        """
+        释放读取数据时使用的资源
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ListSource(TransactionSource):
+    """
+    内存中的事务列表
+    """
+
+    def __init__(self, data):
+        super().__init__()
+        self.data = data
+
+    def chunks(self, chunk_size=100000):
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+
+class BasketFileSource(TransactionSource):
+    """
+    每行一条事务的文本文件，项之间以sep分隔
+    """
+
+    def __init__(self, path, sep=None, item_type=str):
+        """
+        :param path: 文件路径
+        :param sep: 分隔符，为None时按空白分隔
+        :param item_type: 项的类型，例如int
+        """
+        super().__init__()
+        self.path = path
+        self.sep = sep
+        self.item_type = item_type
+
+    def chunks(self, chunk_size=100000):
+        chunk = []
+        with open(self.path, mode='r', encoding='utf8') as fp:
+            for line in fp:
+                items = [self.item_type(item) for item in line.strip().split(self.sep) if item != '']
+                if not items:
+                    continue
+                chunk.append(items)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+
+class RetailrocketSource(TransactionSource):
+    """
+    retailrocket的events.csv(timestamp,visitorid,event,itemid,transactionid)按访客或订单分组得到的事务
+    同一个访客/订单的行在文件中不一定相邻，先按分组键取模把行分散到num_buckets个临时文件中(外部分组)，
+    每个临时文件只包含一部分分组键，可以单独放入内存完成分组
+    临时文件在close时删除，可以用with语句保证删除
+    """
+
+    def __init__(self, path, key='transactionid', events=('transaction',), num_buckets=16, read_rows=1000000):
+        """
+        :param path: events.csv路径
+        :param key: 分组键，transactionid(订单)或visitorid(访客)
+        :param events: 参与分组的事件类型，为None时使用全部事件
+        :param num_buckets: 临时文件个数，数据越大需要越多，保证每个临时文件能放入内存
+        :param read_rows: 每次从events.csv读取的行数
+        """
+        super().__init__()
+        if key not in ('transactionid', 'visitorid'):
+            raise ValueError(f'不支持的分组键: {key}')
+        self.path = path
+        self.key = key
+        self.events = events
+        self.num_buckets = num_buckets
+        self.read_rows = read_rows
+        self.bucket_dir = None
+
+    def split_buckets(self):
+        """
+        第一次遍历时把(分组键, 项)按分组键取模写入临时文件，之后的遍历直接读取临时文件
+        """
+        if self.bucket_dir is not None:
+            return
+
+        bucket_dir = tempfile.mkdtemp(prefix='retailrocket_')
+        try:
+            files = [open(os.path.join(bucket_dir, f'{bucket}.bin'), mode='wb') for bucket in range(self.num_buckets)]
+            try:
+                for frame in pd.read_csv(self.path, usecols=[self.key, 'event', 'itemid'], chunksize=self.read_rows):
+                    if self.events is not None:
+                        frame = frame[frame['event'].isin(self.events)]
+                    frame = frame.dropna(subset=[self.key])
+                    pairs = np.column_stack([frame[self.key].values, frame['itemid'].values]).astype(np.int64)
+                    buckets = pairs[:, 0] % self.num_buckets
+                    for bucket in np.unique(buckets).tolist():
+                        files[bucket].write(pairs[buckets == bucket].tobytes())
+            finally:
+                for fp in files:
+                    fp.close()
+        except BaseException:
+            shutil.rmtree(bucket_dir, ignore_errors=True)
+            raise
+        self.bucket_dir = bucket_dir
+
+    def chunks(self, chunk_size=100000):
+        self.split_buckets()
+        chunk = []
+        for bucket in range(self.num_buckets):
+            pairs = np.fromfile(os.path.join(self.bucket_dir, f'{bucket}.bin'), dtype=np.int64).reshape(-1, 2)
+            if len(pairs) == 0:
+                continue
+            # 按分组键排序后切段，每段为一条事务，同一事务中重复的项只保留一次
+            pairs = np.unique(pairs, axis=0)
+            bounds = np.flatnonzero(np.diff(pairs[:, 0])) + 1
+            for items in np.split(pairs[:, 1], bounds):
+                chunk.append(items.tolist())
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def close(self):
+        """
+        删除临时文件
+        """
+        if self.bucket_dir is not None:
+            shutil.rmtree(self.bucket_dir, ignore_errors=True)
+            self.bucket_dir = None
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @File    : ann_index.py
+# @Software: PyCharm
+# @Description: 基于随机超平面投影的局部敏感哈希(LSH)，为余弦相似度召回候选物品
+
+import time
+import random
+
+import numpy as np
+
+
+class RandomProjectionLSH(object):
+    """
+    随机超平面LSH: 每张哈希表随机取n_bits个超平面，向量落在超平面哪一侧决定一位编码，
+    夹角越小的两个向量编码相同的概率越高。查询时取各表中与查询向量编码相同的桶的并集作为候选
+    召回率和耗时的权衡:
+        n_tables越多召回率越高，候选越多
+        n_bits越多桶越小，候选越少，召回率越低
+        n_probes为每张表额外查询的桶数，依次翻转投影值最接近0的位
+    """
+    def __init__(self, matrix, n_tables=8, n_bits=8, seed=0):
+        """
+        :param matrix: 按行归一化的物品特征矩阵
+        :param n_tables: 哈希表个数
+        :param n_bits: 每张表的编码位数
+        :param seed: 随机超平面的种子
+        """
+        super().__init__()
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        rng = np.random.default_rng(seed)
+        # 所有表的超平面放在一起，(维度, n_tables * n_bits)
+        self.planes = rng.standard_normal((matrix.shape[1], n_tables * n_bits)).astype(np.float32)
+        self.weights = np.left_shift(1, np.arange(n_bits, dtype=np.int64))
+
+        # 每张表按编码排序后的物品行号，同一个桶的物品连续存放，通过二分查找定位桶的区间
+        codes = self.hash(np.asarray(matrix, dtype=np.float32))
+        self.orders = np.argsort(codes, axis=0, kind='stable').T
+        self.sorted_codes = np.take_along_axis(codes, self.orders.T, axis=0).T
+
+    def project(self, vectors):
+        """
+        :return: 投影值，(n, n_tables, n_bits)
+        """
+        return (vectors @ self.planes).reshape(len(vectors), self.n_tables, self.n_bits)
+
+    def hash(self, vectors):
+        """
+        :return: 编码，(n, n_tables)
+        """
+        return (self.project(vectors) > 0) @ self.weights
+
+    def candidates(self, vector, n_probes=0):
+        """
+        召回与vector可能相似的物品
+        :param vector: 查询向量
+        :param n_probes: 每张表额外查询的桶数
+        :return: 候选物品行号，升序排列
+        """
+        projection = self.project(np.asarray(vector, dtype=np.float32)[None, :])[0]
+        codes = (projection > 0) @ self.weights
+        # 投影值离0越近的位越可能与相似物品不同，按这个顺序依次翻转
+        flips = np.argsort(np.abs(projection), axis=1)[:, :n_probes]
+
+        parts = []
+        for table in range(self.n_tables):
+            probes = [codes[table]] + [codes[table] ^ int(self.weights[bit]) for bit in flips[table]]
+            sorted_codes = self.sorted_codes[table]
+            for code in probes:
+                start = np.searchsorted(sorted_codes, code, side='left')
+                end = np.searchsorted(sorted_codes, code, side='right')
+                parts.append(self.orders[table, start:end])
+
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(parts))
+
+
+def benchmark_recall(recommender, users, settings, k=10):
+    """
+    对比LSH召回和精确计算的推荐结果，分数不低于精确结果中第k个分数的推荐都算命中(特征相同的物品分数并列)
+    :param recommender: CBMovieRecommend
+    :param users: 参与评估的用户
+    :param settings: [(n_tables, n_bits, n_probes)]
+    :param k: 推荐个数
+    :return: (精确计算每个用户的平均耗时, [(n_tables, n_bits, n_probes, recall@k, 平均候选数, 每个用户的平均耗时)])
+    """
+    recommender.ann = None
+    exact = dict()
+    start = time.time()
+    for user in users:
+        exact[user] = recommender.recommend_items(user, k)
+    exact_elapsed = (time.time() - start) / max(len(users), 1)
+
+    result = []
+    for n_tables, n_bits, n_probes in settings:
+        recommender.build_ann(n_tables=n_tables, n_bits=n_bits, n_probes=n_probes)
+        hit, total, n_candidates = 0, 0, 0
+        start = time.time()
+        for user in users:
+            approx = recommender.recommend_items(user, k)
+            if exact[user]:
+                lowest = exact[user][-1][1]
+                hit += sum(1 for _, score in approx if score >= lowest - 1e-6)
+                total += len(exact[user])
+        elapsed = (time.time() - start) / max(len(users), 1)
+        for user in users:
+            vector = recommender.user_matrix[recommender.user_row(user)]
+            n_candidates += len(recommender.ann.candidates(vector, n_probes))
+        recall = hit / total if total else 0.0
+        result.append((n_tables, n_bits, n_probes, recall, n_candidates / max(len(users), 1), elapsed))
+
+    recommender.ann = None
+    return exact_elapsed, result
+
+
+if __name__ == '__main__':
+    from content_based_movie_recommend import CBMovieRecommend
+
+    cb = CBMovieRecommend(K=10)
+    sample = random.sample(cb.user_ids.tolist(), min(200, len(cb.user_ids)))
+    grid = [(4, 8, 0), (8, 8, 0), (8, 8, 2), (16, 8, 2), (8, 12, 0), (16, 12, 4)]
+    exact_elapsed, rows = benchmark_recall(cb, sample, grid, k=10)
+    print(f'精确计算: {len(cb.item_ids)}个候选, {exact_elapsed * 1000:.3f} ms/user')
+    print('n_tables n_bits n_probes recall@10 candidates ms/user')
+    for row in rows:
+        print('{:8d} {:6d} {:8d} {:9.4f} {:10.1f} {:7.3f}'.format(*row[:5], row[5] * 1000))
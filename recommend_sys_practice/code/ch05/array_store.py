@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @File    : array_store.py
+# @Software: PyCharm
+# @Description: 把多个命名数组保存在一个二进制文件中，可以通过numpy.memmap直接打开，特征信息文件和近邻索引文件共用这种格式
+
+import os
+import json
+import struct
+
+import numpy as np
+
+# 文件格式(小端序):
+#     header: magic(8s) version(uint32) reserved(uint32) toc_bytes(int64)
+#     toc:    utf-8编码的JSON，{'meta': {...}, 'arrays': {name: [dtype, shape, offset]}}
+#     arrays: 按C顺序依次存放，每个数组的起始位置按64字节对齐
+MAGIC = b'RSPROF\x00\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sIIq')
+ALIGN = 64
+
+
+def _align(offset, size=ALIGN):
+    return (offset + size - 1) // size * size
+
+
+def save_arrays(path, arrays, meta=None):
+    """
+    将多个数组保存到一个文件中，先写临时文件再替换，避免其他进程读到写了一半的文件
+    :param path: 文件路径
+    :param arrays: {名称: 数组}
+    :param meta: 可以序列化为JSON的附加信息
+    :return:
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    # 先用占位的偏移量算出目录的长度，偏移量固定为20位数字，目录长度不会因为填入真实值而变化
+    toc = {'meta': meta or {}, 'arrays': {}}
+    for name, array in arrays.items():
+        toc['arrays'][name] = [array.dtype.newbyteorder('<').str, list(array.shape), 10 ** 19]
+    toc_bytes = len(json.dumps(toc).encode('utf8'))
+
+    offset = _align(HEADER.size + toc_bytes)
+    for name, array in arrays.items():
+        toc['arrays'][name][2] = offset
+        offset = _align(offset + array.nbytes)
+    toc = json.dumps(toc).encode('utf8').ljust(toc_bytes)
+
+    tmp_path = f'{path}.tmp.{os.getpid()}'
+    with open(tmp_path, mode='wb') as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, 0, len(toc)))
+        fp.write(toc)
+        for array in arrays.values():
+            fp.write(b'\x00' * (_align(fp.tell()) - fp.tell()))
+            fp.write(array.astype(array.dtype.newbyteorder('<'), copy=False).tobytes())
+    os.replace(tmp_path, path)
+
+
+def open_arrays(path, mmap=True):
+    """
+    打开save_arrays保存的文件
+    :param path: 文件路径
+    :param mmap: 为True时数组通过numpy.memmap映射，只在访问时才从磁盘读入
+    :return: ({名称: 数组}, meta)
+    """
+    with open(path, mode='rb') as fp:
+        magic, version, _, toc_bytes = HEADER.unpack(fp.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f'不是数组文件: {path}')
+        if version != VERSION:
+            raise ValueError(f'不支持的数组文件版本: {version}')
+        toc = json.loads(fp.read(toc_bytes).decode('utf8'))
+
+    arrays = dict()
+    for name, (dtype, shape, offset) in toc['arrays'].items():
+        shape = tuple(shape)
+        if mmap and int(np.prod(shape)) > 0:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            with open(path, mode='rb') as fp:
+                fp.seek(offset)
+                arrays[name] = np.fromfile(fp, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+    return arrays, toc['meta']
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @File    : batch_recommend.py
+# @Software: PyCharm
+# @Description: 批量推荐用到的矩阵构建和TopN选取
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def select_rows(matrix, row_index, users):
+    """
+    按用户列表取出评分矩阵的行，直接复制CSR数组中的区间
+    :param matrix: CSR矩阵
+    :param row_index: 用户ID -> 行号
+    :param users: 用户列表，决定结果的行，不在row_index中的用户为空行
+    :return: CSR矩阵，shape为(len(users), matrix.shape[1])
+    """
+    rows = np.array([row_index.get(user, -1) for user in users], dtype=np.int64)
+    found = rows >= 0
+    rows = np.where(found, rows, 0)
+    counts = np.where(found, np.diff(matrix.indptr)[rows], 0)
+    indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    # 结果中每个元素在原矩阵中的位置 = 所在行的起点 + 在行内的偏移
+    source = np.repeat(matrix.indptr[rows], counts) + np.arange(indptr[-1]) - np.repeat(indptr[:-1], counts)
+    return sp.csr_matrix((matrix.data[source], matrix.indices[source], indptr), shape=(len(users), matrix.shape[1]))
+
+
+def remap_columns(matrix, col_ids, item_index):
+    """
+    把评分矩阵的列换成另一套物品编码
+    :param matrix: CSR矩阵，列按col_ids编码
+    :param col_ids: 列号 -> 物品ID
+    :param item_index: 物品ID -> 新的列号，不在其中的物品被忽略
+    :return: CSR矩阵，shape为(matrix.shape[0], len(item_index))
+    """
+    cols = np.array([item_index.get(item, -1) for item in col_ids], dtype=np.int64)
+    entries = matrix.tocoo()
+    new_cols = cols[entries.col]
+    keep = new_cols >= 0
+    return sp.csr_matrix((entries.data[keep], (entries.row[keep], new_cols[keep])),
+                         shape=(matrix.shape[0], len(item_index)))
+
+
+def select_top_n(scores, seen, nitems):
+    """
+    为每一行选出分数最高的nitems个候选
+    :param scores: 候选分数矩阵(CSR)，只有存储了的元素才是候选
+    :param seen: 用户已经评价过的物品(CSR)，存储了的元素不参与推荐
+    :param nitems: 每行选取的个数
+    :return: [(列号数组, 分数数组)]，每行按分数从大到小排列
+    """
+    n_rows, n_cols = scores.shape
+    nitems = min(nitems, n_cols)
+    if n_rows == 0 or nitems <= 0:
+        return [(np.empty(0, dtype=np.int64), np.empty(0)) for _ in range(n_rows)]
+
+    dense = np.full(scores.shape, -np.inf)
+    candidates = scores.tocoo()
+    dense[candidates.row, candidates.col] = candidates.data
+    seen = seen.tocoo()
+    dense[seen.row, seen.col] = -np.inf
+
+    # argpartition只保证前nitems个是最大的，再对这nitems个排序
+    top = np.argpartition(-dense, nitems - 1, axis=1)[:, :nitems]
+    top_scores = np.take_along_axis(dense, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    result = []
+    for cols, values in zip(top, top_scores):
+        valid = np.isfinite(values)
+        result.append((cols[valid], values[valid]))
+
+    return result
@@ -11,9 +11,160 @@
 import pandas as pd
 import json
 import codecs
+import csv
+import io
+import os
 import numpy as np
-import math
+import scipy.sparse as sp
 import random
+import multiprocessing
+
+from ann_index import RandomProjectionLSH
+from array_store import save_arrays, open_arrays
+
+
+# 各数据文件的列名和类型
+USER_COLUMNS = {'UserID': np.int32, 'Gender': 'category', 'Age': np.int8, 'Occupation': np.int8, 'Zip-code': str}
+RATING_COLUMNS = {'UserID': np.int32, 'MovieID': np.int32, 'Rating': np.int8, 'TimeStamp': np.int64}
+MOVIE_COLUMNS = {'MovieID': np.int32, 'Title': str, 'Genres': str}
+
+# 预处理结果支持的文件格式，parquet和feather需要安装pyarrow
+TABLE_FORMATS = ('csv', 'parquet', 'feather')
+
+# prepare_item_profile和prepare_user_profile生成的JSON特征信息
+ITEM_PROFILE = 'data/item_profile.json'
+USER_PROFILE = 'data/user_profile.json'
+
+# 推荐时使用的特征信息文件，包含归一化的电影/用户特征矩阵、ID以及用户评价过的电影
+PROFILE_STORE = 'data/cb_profile.bin'
+
+
+# 子进程通过fork继承的推荐器，特征矩阵是memmap，子进程共享同一份页缓存
+_evaluating = None
+
+
+def _hit_ratio(users):
+    return _evaluating.hit_ratio(users)
+
+
+def read_dat(file, columns, encoding='latin-1'):
+    """
+    读取以'::'分隔的MovieLens数据文件
+    多字符分隔符只能用python解析器逐行按正则切分，这里先把'::'整体替换为制表符，再交给pandas的C解析器
+    :param file: 文件路径
+    :param columns: {列名: 类型}
+    :param encoding: 文件编码，ml-1m的电影名中有latin-1字符
+    :return: DataFrame
+    """
+    with open(file, mode='rb') as fp:
+        content = fp.read().replace(b'::', b'\t')
+    return pd.read_csv(io.BytesIO(content), sep='\t', names=list(columns.keys()), dtype=columns,
+                       encoding=encoding, quoting=csv.QUOTE_NONE, engine='c')
+
+
+def table_path(name, fmt='csv'):
+    """
+    预处理结果的保存路径
+    :param name: 表名
+    :param fmt: 文件格式，csv/parquet/feather
+    :return: data/<name>.<fmt>
+    """
+    if fmt not in TABLE_FORMATS:
+        raise ValueError(f'不支持的文件格式: {fmt}')
+    return f'data/{name}.{fmt}'
+
+
+def save_table(frame, name, fmt='csv'):
+    """
+    保存预处理结果
+    :param frame: DataFrame
+    :param name: 表名，保存为data/<name>.<fmt>
+    :param fmt: 文件格式，csv/parquet/feather
+    :return: 保存路径
+    """
+    path = table_path(name, fmt)
+    if fmt == 'csv':
+        frame.to_csv(path, index=False)
+    elif fmt == 'parquet':
+        frame.to_parquet(path, index=False)
+    else:
+        frame.reset_index(drop=True).to_feather(path)
+    return path
+
+
+def load_table(path, columns=None):
+    """
+    按扩展名读取预处理结果
+    :param path: 文件路径
+    :param columns: 只读取的列，为None时读取全部列
+    :return: DataFrame
+    """
+    fmt = os.path.splitext(path)[1].lstrip('.')
+    if fmt not in TABLE_FORMATS:
+        raise ValueError(f'不支持的文件格式: {fmt}')
+    if fmt == 'parquet':
+        return pd.read_parquet(path, columns=columns)
+    if fmt == 'feather':
+        return pd.read_feather(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+
+def file_stats(paths):
+    """
+    文件的大小和修改时间，用于判断特征信息文件生成之后源文件是否有变化
+    :param paths: 文件路径列表
+    :return: {路径: [文件大小, 修改时间(ns)]}，不存在的文件为None
+    """
+    stats = dict()
+    for path in paths:
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats[path] = [stat.st_size, stat.st_mtime_ns]
+        else:
+            stats[path] = None
+    return stats
+
+
+def normalize_profile(profile):
+    """
+    将{id: 特征向量}形式的特征信息转换为按ID升序排列、按行归一化的矩阵
+    :param profile: 特征信息
+    :return: (ids, matrix)，ids为int64数组，matrix为float32矩阵，模为0的向量保持为0
+    """
+    ids = np.asarray([int(one) for one in profile.keys()], dtype=np.int64)
+    matrix = np.asarray(list(profile.values()), dtype=np.float32).reshape(len(ids), -1)
+    order = np.argsort(ids, kind='stable')
+    ids, matrix = ids[order], matrix[order]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return ids, matrix
+
+
+def build_seen_index(user_ids, item_ids, users, items):
+    """
+    按用户分段存储评价过的物品行号:
+        rows[indptr[r]:indptr[r+1]]是user_ids[r]评价过的物品在item_ids中的行号，按行号升序排列
+    :param user_ids: 升序排列的用户ID
+    :param item_ids: 升序排列的物品ID
+    :param users: 评分记录中的用户ID
+    :param items: 评分记录中的物品ID
+    :return: (indptr, rows)，不在user_ids或item_ids中的评分被忽略
+    """
+    def lookup(ids, keys):
+        rows = np.searchsorted(ids, keys)
+        rows[rows >= len(ids)] = 0
+        found = ids[rows] == keys if len(ids) > 0 else np.zeros(len(keys), dtype=bool)
+        return rows, found
+
+    user_rows, user_found = lookup(user_ids, np.asarray(users, dtype=np.int64))
+    item_rows, item_found = lookup(item_ids, np.asarray(items, dtype=np.int64))
+    valid = user_found & item_found
+    user_rows, item_rows = user_rows[valid], item_rows[valid]
+
+    order = np.lexsort((item_rows, user_rows))
+    counts = np.bincount(user_rows, minlength=len(user_ids))
+    indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    return indptr, item_rows[order].astype(np.int32)
 
 
 class DataProcessing(object):
@@ -24,147 +175,288 @@ class DataProcessing(object):
         super().__init__()
         self.item_dict = {}
         self.genres_all = None
+        self.item_ids = None
+        self.item_genres = None
         self.item_matrix = {}
         self.user_matrix = {}
 
-    def process(self):
+    def process(self, fmt='csv'):
         print('开始转换用户数据(users.data)...')
-        self.process_user_data()
+        self.process_user_data(fmt=fmt)
         print('开始转换电影数据(movies.data)...')
-        self.process_movies_data()
+        self.process_movies_data(fmt=fmt)
         print('开始转换评分数据(ratings.data)...')
-        self.process_rating_data()
+        self.process_rating_data(fmt=fmt)
         print('转换完成')
 
-    def process_user_data(self, file='../../data/ml-1m/users.dat'):
+    def process_user_data(self, file='../../data/ml-1m/users.dat', fmt='csv'):
         """
         处理用户数据
         :param file:
+        :param fmt: 输出文件格式，csv/parquet/feather
         :return:
         """
-        fp = pd.read_table(file, sep='::', engine='python', names=['UserID', 'Gender', 'Age', 'Occupation', 'Zip-code'])
-        fp.to_csv('data/users.csv', index=False)
+        fp = read_dat(file, USER_COLUMNS)
+        save_table(fp, 'users', fmt)
 
-    def process_rating_data(self, file='../../data/ml-1m/ratings.dat'):
+    def process_rating_data(self, file='../../data/ml-1m/ratings.dat', fmt='csv'):
         """
         处理评分数据
         :param file:
+        :param fmt: 输出文件格式，csv/parquet/feather
         :return:
         """
-        fp = pd.read_table(file, sep='::', engine='python', names=['UserID', 'MovieID', 'Rating', 'TimeStamp'])
-        fp.to_csv('data/ratings.csv', index=False)
+        fp = read_dat(file, RATING_COLUMNS)
+        save_table(fp, 'ratings', fmt)
 
-    def process_movies_data(self, file='../../data/ml-1m/movies.dat'):
+    def process_movies_data(self, file='../../data/ml-1m/movies.dat', fmt='csv'):
         """
         处理电影数据
         :param file:
+        :param fmt: 输出文件格式，csv/parquet/feather
         :return:
         """
-        fp = pd.read_table(file, sep='::', engine='python', names=['MovieID', 'Title', 'Genres'])
-        fp.to_csv('data/movies.csv', index=False)
+        fp = read_dat(file, MOVIE_COLUMNS)
+        save_table(fp, 'movies', fmt)
 
-    def prepare_item_profile(self, file='data/movies.csv'):
+    def load_genres(self, file=None, fmt='csv'):
+        """
+        按第一次出现的顺序列出电影数据中的全部类型，与prepare_item_profile中特征的列一致
+        :param file: 电影数据，为None时使用process按fmt保存的data/movies.<fmt>
+        :param fmt: process保存预处理结果时使用的文件格式
+        :return: 类型列表
+        """
+        items = load_table(file or table_path('movies', fmt), columns=['MovieID', 'Genres'])
+        genre_index = dict()
+        for genres in items.drop_duplicates('MovieID')['Genres'].fillna('').values:
+            for genre in genres.split('|'):
+                if genre:
+                    genre_index.setdefault(genre, len(genre_index))
+        return list(genre_index.keys())
+
+    def prepare_item_profile(self, file=None, fmt='csv'):
         """
         计算电影的特征信息矩阵，并保存在文件中
-        :param file:
+        :param file: 电影数据，为None时使用process按fmt保存的data/movies.<fmt>
+        :param fmt: process保存预处理结果时使用的文件格式
         :return:
         """
-        items = pd.read_csv(file)
-        item_ids = set(items['MovieID'].values)
-        genres_all = list()
+        items = load_table(file or table_path('movies', fmt), columns=['MovieID', 'Genres'])
+        items = items.drop_duplicates('MovieID')
+        item_ids = items['MovieID'].values
 
-        # 将每个电影的类型放在item_dict中
-        for item in item_ids:
-            genres = items[items['MovieID'] == item]['Genres'].values[0].split('|')
-            self.item_dict.setdefault(item, []).extend(genres)
-            genres_all.extend(genres)
+        # 一次遍历所有电影，类型 -> 列号的字典按类型第一次出现的顺序编号
+        genre_index = dict()
+        rows, cols = [], []
+        for row, (item, genres) in enumerate(zip(item_ids.tolist(), items['Genres'].fillna('').values)):
+            genres = [genre for genre in genres.split('|') if genre]
+            self.item_dict[item] = genres
+            for genre in genres:
+                rows.append(row)
+                cols.append(genre_index.setdefault(genre, len(genre_index)))
 
-        self.genres_all = set(genres_all)
+        self.genres_all = list(genre_index.keys())
+        # 电影 x 类型的one-hot矩阵，行与self.item_ids对应，列与self.genres_all对应
+        self.item_ids = item_ids
+        self.item_genres = np.zeros((len(item_ids), len(genre_index)), dtype=np.uint8)
+        self.item_genres[rows, cols] = 1
+        self.item_matrix = dict(zip([str(item) for item in item_ids.tolist()], self.item_genres.tolist()))
 
-        genres_all_list = list(self.genres_all)
-        # 将每个电影的特征信息矩阵存放在self.item_matrix中
-        for item in self.item_dict.keys():
-            self.item_matrix[str(item)] = [0] * len(self.genres_all)
-            for genre in self.item_dict[item]:
-                index = genres_all_list.index(genre)
-                self.item_matrix[str(item)][index] = 1
-
-        save_path = 'data/item_profile.json'
-        json.dump(self.item_matrix, codecs.open(save_path, mode='w', encoding='utf8'))
+        save_path = ITEM_PROFILE
+        with codecs.open(save_path, mode='w', encoding='utf8') as fw:
+            json.dump(self.item_matrix, fw)
         print(f'item 信息计算完成, 保存路径为：{save_path}')
 
-    def prepare_user_profile(self, file='data/ratings.csv'):
+    def prepare_user_profile(self, file=None, fmt='csv'):
         """
         计算用户的偏好矩阵，并保存在文件中
-        :param file:
+        :param file: 评分数据，为None时使用process按fmt保存的data/ratings.<fmt>
+        :param fmt: process保存预处理结果时使用的文件格式
         :return:
         """
-        users = pd.read_csv(file)
-        user_ids = set(users['UserID'].values)
-
-        # 将users信息转换成dict
-        users_rating_dict = {}
-        for user in user_ids:
-            users_rating_dict.setdefault(str(user), {})
-
-        with codecs.open(file, mode='r', encoding='utf8') as fr:
-            for line in fr.readlines():
-                if not line.startswith('UserID'):
-                    (user, item, rate) = line.split(',')[:3]
-                    users_rating_dict[user][item] = int(rate)
-
-        # 获取用户对每个类型下的哪些电影进行了评分
-        for user in users_rating_dict.keys():
-            print(f'user is {user}')
-            score_list = users_rating_dict[user].values()
-            # 用户的平均打分
-            avg = sum(score_list) / len(score_list)
-            self.user_matrix[user] = []
-            # 遍历每个类型，保证item_profile和user_profile信息矩阵中没列表式的类型一致
-            for genre in self.genres_all:
-                score_all = 0.0
-                score_len = 0
-                # 遍历每个item
-                for item in users_rating_dict[user].keys():
-                    # 判断类型是否在用户评分过的电影里
-                    if genre in self.item_dict[int(item)]:
-                        score_all += (users_rating_dict[user][item] - avg)
-                        score_len += 1
-
-                if score_len == 0:
-                    self.user_matrix[user].append(0.0)
-                else:
-                    self.user_matrix[user].append(score_all / score_len)
-
-        save_path = 'data/user_profile.json'
-        json.dump(self.user_matrix, codecs.open(save_path, mode='w', encoding='utf8'))
+        if self.item_genres is None:
+            self.prepare_item_profile(fmt=fmt)
+
+        ratings = load_table(file or table_path('ratings', fmt), columns=['UserID', 'MovieID', 'Rating'])
+        user_ids, users = np.unique(ratings['UserID'].values, return_inverse=True)
+        scores = ratings['Rating'].values.astype(np.float64)
+        # 用户的平均打分
+        avg = np.bincount(users, weights=scores) / np.bincount(users)
+
+        # 电影ID -> self.item_ids中的行号，不在电影数据中的评分不参与计算
+        item_index = pd.Index(self.item_ids)
+        items = item_index.get_indexer(ratings['MovieID'].values)
+        valid = items >= 0
+        users, items = users[valid], items[valid]
+        centered = scores[valid] - avg[users]
+
+        # (用户 x 电影) x (电影 x 类型)，分别得到每个类型下去均值评分的和以及评分过的电影数
+        shape = (len(user_ids), len(self.item_ids))
+        item_genres = sp.csr_matrix(self.item_genres, dtype=np.float64)
+        score_all = (sp.csr_matrix((centered, (users, items)), shape=shape) @ item_genres).toarray()
+        score_len = (sp.csr_matrix((np.ones(len(users)), (users, items)), shape=shape) @ item_genres).toarray()
+        profile = np.zeros_like(score_all)
+        np.divide(score_all, score_len, out=profile, where=score_len > 0)
+
+        # 列与self.genres_all一致，保证item_profile和user_profile信息矩阵中的类型一致
+        self.user_matrix = dict(zip([str(user) for user in user_ids.tolist()], profile.tolist()))
+
+        save_path = USER_PROFILE
+        with codecs.open(save_path, mode='w', encoding='utf8') as fw:
+            json.dump(self.user_matrix, fw)
         print(f'user 信息计算完成，保存路径为 {save_path}')
 
+    def prepare_profile_store(self, item_file=ITEM_PROFILE, user_file=USER_PROFILE,
+                              rating_file=None, save_path=PROFILE_STORE, fmt='csv'):
+        """
+        把电影和用户的特征信息、ID以及用户评价过的电影保存为一个二进制文件，供CBMovieRecommend通过memmap打开
+        meta中记录类型列表和各个源文件的大小、修改时间，源文件变化后CBMovieRecommend会重新生成
+        :param item_file: prepare_item_profile生成的电影特征信息
+        :param user_file: prepare_user_profile生成的用户偏好信息
+        :param rating_file: 评分数据，为None时使用process按fmt保存的data/ratings.<fmt>
+        :param save_path: 保存路径
+        :param fmt: process保存预处理结果时使用的文件格式
+        :return:
+        """
+        with codecs.open(item_file, mode='r', encoding='utf8') as fr:
+            item_profile = json.load(fr)
+        item_ids, item_matrix = normalize_profile(item_profile)
+        # 每个电影在item_profile.json中的位置，即在movies.csv中的顺序，评估时分数相同的电影按这个顺序取
+        item_order = np.argsort(np.asarray([int(one) for one in item_profile.keys()], dtype=np.int64), kind='stable')
+        with codecs.open(user_file, mode='r', encoding='utf8') as fr:
+            user_ids, user_matrix = normalize_profile(json.load(fr))
+        rating_file = rating_file or table_path('ratings', fmt)
+        ratings = load_table(rating_file, columns=['UserID', 'MovieID'])
+        seen_indptr, seen_rows = build_seen_index(user_ids, item_ids,
+                                                  ratings['UserID'].values, ratings['MovieID'].values)
+
+        arrays = {
+            'item_ids': item_ids, 'item_matrix': item_matrix, 'item_order': item_order,
+            'user_ids': user_ids, 'user_matrix': user_matrix,
+            'seen_indptr': seen_indptr, 'seen_rows': seen_rows,
+        }
+        # 没有在当前对象中调用过prepare_item_profile时，从电影数据中读取类型
+        genres = self.genres_all if self.genres_all is not None else self.load_genres(fmt=fmt)
+        meta = {'genres': genres, 'sources': file_stats([item_file, user_file, rating_file])}
+        save_arrays(save_path, arrays, meta=meta)
+        print(f'特征信息文件生成完成，保存路径为 {save_path}')
+
 
 class CBMovieRecommend(object):
     """
     基于内容推荐的推荐类
     """
-    def __init__(self, K):
+    def __init__(self, K, store_file=PROFILE_STORE, fmt='csv'):
         # 加载DataProcessing中预处理的数据
         super().__init__()
         # 给用户推荐的item个数
         self.K = K
-        self.item_profile = json.load(codecs.open('data/item_profile.json', mode='r', encoding='utf8'))
-        self.user_profile = json.load(codecs.open('data/user_profile.json', mode='r', encoding='utf8'))
-        self.items = pd.read_csv('data/movies.csv')
-        self.ratings = pd.read_csv('data/ratings.csv')
+        # DataProcessing.process保存预处理结果时使用的文件格式，生成特征信息文件时按这个格式读取评分数据
+        self.fmt = fmt
+        # DataProcessing.prepare_profile_store生成的特征信息文件，第一次用到时才通过memmap打开，
+        # 不存在或者JSON特征信息、评分数据在生成之后有变化时重新生成
+        self.store_file = store_file
+        self.store = None
+        self.genres_all = None
+        # 评估时使用的(列 -> 不同特征的行号, 不同的电影特征)，见ordered_profiles
+        self.profiles = None
+        # 近似近邻索引，为None时对全部物品精确计算
+        self.ann = None
+        self.n_probes = 0
+
+    def open_store(self):
+        if self.store is None:
+            store, meta = open_arrays(self.store_file) if os.path.exists(self.store_file) else (None, {})
+            sources = file_stats([ITEM_PROFILE, USER_PROFILE, table_path('ratings', self.fmt)])
+            if meta.get('sources') != sources:
+                DataProcessing().prepare_profile_store(save_path=self.store_file, fmt=self.fmt)
+                store, meta = open_arrays(self.store_file)
+            self.store = store
+            self.genres_all = meta['genres']
+        return self.store
+
+    @property
+    def item_ids(self):
+        """
+        按ID升序排列的电影ID
+        """
+        return self.open_store()['item_ids']
+
+    @property
+    def item_matrix(self):
+        """
+        按行归一化的电影特征矩阵(float32)，行与self.item_ids对应
+        """
+        return self.open_store()['item_matrix']
+
+    @property
+    def user_ids(self):
+        """
+        按ID升序排列的用户ID
+        """
+        return self.open_store()['user_ids']
+
+    @property
+    def user_matrix(self):
+        """
+        按行归一化的用户偏好矩阵(float32)，行与self.user_ids对应，用户对物品的喜好程度即两个向量的内积
+        """
+        return self.open_store()['user_matrix']
+
+    @staticmethod
+    def find_row(ids, key):
+        row = int(np.searchsorted(ids, int(key)))
+        if row >= len(ids) or ids[row] != int(key):
+            raise KeyError(key)
+        return row
+
+    def item_row(self, item):
+        return self.find_row(self.item_ids, item)
+
+    def user_row(self, user):
+        return self.find_row(self.user_ids, user)
+
+    def get_seen_rows(self, user):
+        """
+        获取用户评价过的物品行号，只取索引中的一段，与用户的历史长度成正比
+        :param user: 用户ID
+        :return: 行号数组，没有评分的用户返回空数组
+        """
+        store = self.open_store()
+        seen_indptr, seen_rows = store['seen_indptr'], store['seen_rows']
+        try:
+            row = self.user_row(user)
+        except KeyError:
+            return np.empty(0, dtype=seen_rows.dtype)
+        return seen_rows[seen_indptr[row]:seen_indptr[row + 1]]
+
+    def score_items(self, user):
+        """
+        一次矩阵向量乘法计算用户对所有物品的喜好程度
+        :param user: 用户ID
+        :return: 与self.item_ids对应的分数数组
+        """
+        return self.item_matrix @ self.user_matrix[self.user_row(user)]
+
+    def score_users(self, users):
+        """
+        一次矩阵乘法计算一批用户对所有物品的喜好程度
+        :param users: 用户ID列表
+        :return: 分数矩阵，行与users对应，列与self.item_ids对应
+        """
+        rows = [self.user_row(user) for user in users]
+        return self.user_matrix[rows] @ self.item_matrix.T
 
     def get_none_score_item(self, user):
         """
         获取用户未进行评分的item列表
+        与recommend_items相同，用已评分物品的行号屏蔽，不构造全部物品的集合
         :param user:
-        :return:
+        :return: 未评分电影ID的集合
         """
-        items = self.items['MovieID'].values
-        have_score_items = self.ratings[self.ratings['UserID'] == user]['MovieID'].values
-        none_score_items = set(items) - set(have_score_items)
-        return none_score_items
+        none_score = np.ones(len(self.item_ids), dtype=bool)
+        none_score[self.get_seen_rows(user)] = False
+        return set(np.asarray(self.item_ids)[none_score].tolist())
 
     def cosUI(self, user, item):
         """
@@ -173,14 +465,43 @@ class CBMovieRecommend(object):
         :param item: 物品ID
         :return:
         """
-        Uia = sum(
-            np.array(self.user_profile[str(user)])
-            *
-            np.array(self.item_profile[str(item)])
-        )
-        Ua = math.sqrt(sum([math.pow(one, 2) for one in self.user_profile[str(user)]]))
-        Ia = math.sqrt(sum([math.pow(one, 2) for one in self.item_profile[str(item)]]))
-        return Uia / (Ua * Ia)
+        return float(self.user_matrix[self.user_row(user)] @ self.item_matrix[self.item_row(item)])
+
+    def build_ann(self, n_tables=8, n_bits=8, n_probes=0, seed=0):
+        """
+        构建LSH索引，之后的推荐只对LSH召回的候选物品计算分数，参数含义见RandomProjectionLSH
+        :param n_tables: 哈希表个数
+        :param n_bits: 每张表的编码位数
+        :param n_probes: 每张表额外查询的桶数
+        :param seed: 随机超平面的种子
+        :return:
+        """
+        self.ann = RandomProjectionLSH(self.item_matrix, n_tables=n_tables, n_bits=n_bits, seed=seed)
+        self.n_probes = n_probes
+
+    def recommend_items(self, user, K):
+        """
+        为用户推荐K个未评分的电影
+        :param user: 用户ID
+        :param K: 推荐个数，为None时返回全部候选
+        :return: [(电影ID, 分数)]，按分数从大到小排列
+        """
+        row = self.user_row(user)
+        if self.ann is None:
+            # 直接用已评分物品的行号屏蔽，不再构造未评分物品的集合
+            candidates = np.ones(len(self.item_ids), dtype=bool)
+            candidates[self.get_seen_rows(user)] = False
+            rows = np.flatnonzero(candidates)
+        else:
+            rows = self.ann.candidates(self.user_matrix[row], n_probes=self.n_probes)
+            rows = rows[~np.isin(rows, self.get_seen_rows(user))]
+        scores = self.item_matrix[rows] @ self.user_matrix[row]
+
+        order = np.argsort(-scores, kind='stable')
+        if K is not None:
+            order = order[:K]
+        item_ids = np.asarray(self.item_ids)
+        return list(zip(item_ids[rows[order]].tolist(), scores[order].tolist()))
 
     def recommend(self, user):
         """
@@ -188,44 +509,89 @@ class CBMovieRecommend(object):
         :param user:
         :return:
         """
-        user_result = {}
-        item_list = self.get_none_score_item(user)
-        for item in item_list:
-            user_result[item] = self.cosUI(user, item)
-
-        if self.K is None:
-            result = sorted(user_result.items(), key=lambda k:k[1], reverse=True)
-        else:
-            result = sorted(user_result.items(), key=lambda k:k[1], reverse=True)[:self.K]
+        result = self.recommend_items(user, self.K)
 
         print(result)
 
-    def evaluate(self):
+    def ordered_profiles(self):
+        """
+        按movies.csv中的顺序排列电影，并把类型相同的电影合并为同一个特征
+        :return: (columns, profiles)，第j个电影(按movies.csv的顺序)的特征为profiles[columns[j]]，profiles为float64矩阵
+        """
+        if self.profiles is None:
+            rows = np.argsort(self.open_store()['item_order'], kind='stable')
+            profiles, inverse = np.unique(np.asarray(self.item_matrix, dtype=np.float64), axis=0, return_inverse=True)
+            self.profiles = (inverse.reshape(-1)[rows], profiles)
+        return self.profiles
+
+    def hit_ratio(self, users):
+        """
+        计算一批用户的评估结果：给用户推荐len(历史)个电影，与历史评分电影的交集占历史评分电影数目的比例
+        与原来逐个电影计算分数后稳定排序的结果相同：分数相同的电影按在movies.csv中的顺序取
+        :param users: 用户ID列表，都需要有评分记录
+        :return: 与users对应的比例数组
+        """
+        store = self.open_store()
+        seen_indptr, seen_rows = store['seen_indptr'], store['seen_rows']
+        rows = np.asarray([self.user_row(user) for user in users], dtype=np.int64)
+        history = (seen_indptr[rows + 1] - seen_indptr[rows]).astype(np.int64)
+        # 每个不同的特征只计算一次分数，特征相同的电影分数完全相等，不会因为矩阵乘法的舍入误差打乱并列
+        # 列按电影在movies.csv中的顺序排列
+        columns, profiles = self.ordered_profiles()
+        scores = (np.asarray(self.user_matrix[rows], dtype=np.float64) @ profiles.T)[:, columns]
+
+        # argpartition选出每行最大的max(history)个分数，排序后第history个即该用户入选的分数下限
+        max_history = int(history.max())
+        top = np.take_along_axis(scores, np.argpartition(-scores, max_history - 1, axis=1)[:, :max_history], axis=1)
+        top = -np.sort(-top, axis=1)
+        threshold = top[np.arange(len(rows)), history - 1][:, None]
+
+        # 高于下限的全部入选，等于下限的按在movies.csv中的顺序补足len(历史)个
+        above = scores > threshold
+        equal = scores == threshold
+        need = history - above.sum(axis=1)
+        recommended = above | (equal & (np.cumsum(equal, axis=1) <= need[:, None]))
+
+        seen = np.zeros(scores.shape, dtype=bool)
+        seen_users = np.repeat(np.arange(len(rows)), history)
+        seen_items = np.concatenate([seen_rows[seen_indptr[row]:seen_indptr[row + 1]] for row in rows])
+        seen_cols = store['item_order'][seen_items]
+        seen[seen_users, seen_cols] = True
+        return (recommended & seen).sum(axis=1) / history
+
+    def evaluate(self, n_users=20, processes=1, batch_size=1000):
         """
         推荐效果评估
         这里采用的评估方法是：给用户推荐的电影和用户本身评分电影的交集与用户本身评分电影的数目比
+        :param n_users: 随机选取的用户个数，为None时评估全部用户
+        :param processes: 进程数，为None时使用全部CPU，不支持fork的平台上在当前进程中计算
+        :param batch_size: 每次矩阵乘法包含的用户数
         :return:
         """
-        evas = []
-        data = pd.read_csv('data/ratings.csv')
-        # 随机选取20个用户进行效果评估
-        random_user = random.sample([one for one in range(1, 6401)], 20)
-        for user in random_user:
-            have_scored_items = data[data['UserID'] == user]['MovieID'].values
-            items = pd.read_csv('data/movies.csv')['MovieID'].values
-            user_result = {}
-            for item in items:
-                user_result[item] = self.cosUI(user, item)
-
-            results = sorted(user_result.items(), key=lambda k:k[1], reverse=True)[:len(have_scored_items)]
-            rec_items = []
-            for one in results:
-                rec_items.append((one[0]))
+        global _evaluating
+        store = self.open_store()
+        seen_indptr = store['seen_indptr']
+        # 在fork之前合并电影特征，子进程直接继承
+        self.ordered_profiles()
+        # 只评估有评分记录的用户
+        users = self.user_ids[np.diff(seen_indptr) > 0].tolist()
+        if n_users is not None:
+            users = random.sample(users, min(n_users, len(users)))
+        if not users:
+            return 0.0
 
-            eva = len(set(rec_items) & set(have_scored_items)) / len(have_scored_items)
-            evas.append(eva)
+        batches = [users[start:start + batch_size] for start in range(0, len(users), batch_size)]
+        _evaluating = self
+        try:
+            if processes == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+                evas = [self.hit_ratio(batch) for batch in batches]
+            else:
+                with multiprocessing.get_context('fork').Pool(processes=processes) as pool:
+                    evas = pool.map(_hit_ratio, batches)
+        finally:
+            _evaluating = None
 
-        return sum(evas) / len(evas)
+        return float(np.concatenate(evas).mean())
 
 
 if __name__ == '__main__':
@@ -233,6 +599,8 @@ if __name__ == '__main__':
     # data_process.process()
     # data_process.prepare_item_profile()
     # data_process.prepare_user_profile()
+    # data/cb_profile.bin不存在或者JSON特征信息、评分数据有变化时，CBMovieRecommend第一次用到时会自动重新生成
+    # data_process.prepare_profile_store()
     cb = CBMovieRecommend(K=10)
     cb.recommend(user=100)
     print(f'推荐评估结果：{cb.evaluate()}')
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @File    : incremental_similarity.py
+# @Software: PyCharm
+# @Description: 新评分到达时增量更新同现矩阵、相似度和TopK近邻，不需要整体重算
+
+import abc
+
+import numpy as np
+import scipy.sparse as sp
+
+from neighbor_index import NeighborIndex, top_k_rows
+from sparse_similarity import encode_ratings, item_cooccurrence_matrix, user_cooccurrence_matrix
+
+# 浮点累加误差范围内的同现值视为0
+EPS = 1e-12
+# 构建近邻索引时每次计算相似度的行数
+BUILD_BLOCK_ROWS = 4096
+
+
+class IncrementalSimilarity(abc.ABC):
+    """
+    增量相似度的公共部分，相似度为w_ab = C_ab / sqrt(n_a * n_b)
+        count: 同现矩阵C(CSR)，行列都按近邻索引的ids编码，不存储对角线和0
+        total: 每行的n_a，物品为有正向评分的用户数，用户为有正向评分的物品数
+        index: TopK近邻索引，只替换相似度发生变化的行
+    子类负责根据新的评分计算同现矩阵的变化量
+    """
+    def __init__(self, train_data, count, total, ids, topk=50):
+        """
+        :param train_data: {user: {item: rating}}形式的训练集，update时会原地修改
+        :param count: 同现矩阵(CSR)
+        :param total: 每行的n_a
+        :param ids: 行号/列号 -> 原始ID
+        :param topk: 每行保留的近邻个数
+        """
+        super().__init__()
+        self.train_data = train_data
+        self.topk = topk
+        self.count = count.tocsr()
+        self.total = np.asarray(total, dtype=np.float64)
+        n = len(ids)
+        self.index = NeighborIndex.from_csr_blocks(
+            (self.similarity_rows(np.arange(start, min(start + BUILD_BLOCK_ROWS, n)))
+             for start in range(0, n, BUILD_BLOCK_ROWS)),
+            ids, topk=topk)
+
+    def add_ids(self, keys):
+        """
+        第一次出现的用户/物品追加到近邻索引、同现矩阵和total的末尾
+        :param keys: 用户/物品ID
+        :return: 新追加的行号
+        """
+        n_old = len(self.index.ids)
+        self.index.add_ids(keys)
+        n = len(self.index.ids)
+        if n > n_old:
+            self.count.resize((n, n))
+            self.total = np.concatenate([self.total, np.zeros(n - n_old)])
+        return np.arange(n_old, n)
+
+    def add_count(self, delta):
+        """
+        把同现矩阵的变化量累加到count上，累加后接近0的元素不再存储
+        :param delta: 同现矩阵的变化量(稀疏矩阵)，对角线上的元素会被忽略
+        :return:
+        """
+        delta = delta.tocsr()
+        count = (self.count + delta - sp.diags(delta.diagonal())).tocsr()
+        count.data[np.abs(count.data) <= EPS] = 0
+        count.eliminate_zeros()
+        self.count = count
+
+    def similarity_rows(self, rows):
+        """
+        根据当前的同现矩阵计算指定行的相似度
+        :param rows: 行号
+        :return: 相似度矩阵(CSR)，第r行对应rows[r]
+        """
+        norm = np.zeros_like(self.total)
+        np.divide(1.0, np.sqrt(self.total), out=norm, where=self.total > 0)
+        sim = (sp.diags(norm[rows]) @ self.count[rows] @ sp.diags(norm)).tocsr()
+        sim.eliminate_zeros()
+        return sim
+
+    def refresh(self, rows):
+        """
+        重新计算指定行的TopK近邻，近邻索引中只替换这些行
+        :param rows: 需要更新的行号，不重复
+        :return:
+        """
+        counts, indices, weights = top_k_rows(self.similarity_rows(rows), self.topk)
+        self.index.update_rows(rows, counts, indices, weights)
+
+    def to_index(self):
+        """
+        当前的TopK近邻索引，返回的索引会随之后的update原地更新
+        :return:
+        """
+        return self.index
+
+    def apply_events(self, events):
+        """
+        逐条把新的评分写入训练集，每写入一条就返回一次，调用方可以按事件顺序更新同现矩阵
+        :param events: [(user, item, rating)]
+        :return: 生成(user, item, delta)，delta为1表示新增一条正向评分，-1表示正向评分变为非正向
+        """
+        for user, item, rating in events:
+            items = self.train_data.setdefault(user, {})
+            old = items.get(item, 0)
+            items[item] = rating
+            delta = int(rating > 0) - int(old > 0)
+            if delta != 0:
+                yield user, item, delta
+
+    def finish_update(self, rows, changed_rows):
+        """
+        n_a发生变化的行中，所有与之同现的行里关于它的相似度也随之变化，一起重算后返回近邻发生变化的ID
+        :param rows: 同现值发生变化的行号
+        :param changed_rows: n_a发生变化的行号
+        :return: 近邻发生变化的ID集合
+        """
+        changed_rows = np.asarray(sorted(changed_rows), dtype=np.int64)
+        rows = np.unique(np.concatenate([np.asarray(rows, dtype=np.int64), changed_rows,
+                                         self.count[changed_rows].indices.astype(np.int64)]))
+        self.refresh(rows)
+        ids = self.index.ids
+        return {ids[row] for row in rows.tolist()}
+
+    @abc.abstractmethod
+    def update(self, events):
+        """
+        增量更新
+        :param events: [(user, item, rating)]
+        :return: 近邻发生变化的ID集合
+        """
+
+
+class IncrementalItemSimilarity(IncrementalSimilarity):
+    """
+    增量更新物品相似度(惩罚热门物品): w_ij = |N(i) ∩ N(j)| / sqrt(|N(i)| * |N(j)|)
+    用户u新增物品i时，只有i与u历史物品的同现次数和|N(i)|发生变化，
+    因此只需要重算i以及与i同现过的物品的近邻
+    """
+    def __init__(self, train_data, topk=50):
+        # 同现次数和每个物品在多少用户中出现，由稀疏矩阵乘法一次算出
+        matrix, _, item_ids = encode_ratings(train_data)
+        count, item_user_count = item_cooccurrence_matrix(matrix)
+        super().__init__(train_data, count, item_user_count, item_ids, topk=topk)
+
+    def update(self, events):
+        """
+        增量更新，一批事件的同现次数变化合并成一个稀疏矩阵后一次累加
+        :param events: [(user, item, rating)]
+        :return: 近邻发生变化的物品集合
+        """
+        events = list(events)
+        new_rows = self.add_ids(item for _, item, _ in events)
+        id_index = self.index.id_index
+        rows, cols, values = [], [], []
+        changed_rows = set()
+        for user, item, delta in self.apply_events(events):
+            others = np.fromiter((id_index[j] for j, rating in self.train_data[user].items()
+                                  if rating > 0 and j != item), dtype=np.int64)
+            i = id_index[item]
+            self.total[i] += delta
+            # 物品i与用户的其它物品两两同现，对称地各加delta
+            rows.extend([np.full(len(others), i), others])
+            cols.extend([others, np.full(len(others), i)])
+            values.append(np.full(2 * len(others), delta, dtype=np.float64))
+            changed_rows.add(i)
+
+        rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+        values = np.concatenate(values) if values else np.zeros(0)
+        self.add_count(sp.csr_matrix((values, (rows, cols)), shape=self.count.shape))
+        # 第一次出现的物品即使没有正向评分也要有一行
+        return self.finish_update(np.concatenate([rows, new_rows]), changed_rows)
+
+
+class IncrementalUserSimilarity(IncrementalSimilarity):
+    """
+    增量更新用户相似度(IUF惩罚热门物品): w_uv = sum_{i ∈ N(u) ∩ N(v)} 1 / log(1 + |N(i)|) / sqrt(|N(u)| * |N(v)|)
+    物品i的用户集合变化后，i的所有用户两两之间的同现值都要按新的权重调整，
+    同一批事件中对同一物品的修改合并后只调整一次
+    """
+    def __init__(self, train_data, topk=50):
+        # 按IUF加权的同现值和每个用户评价过的物品个数，由稀疏矩阵乘法一次算出
+        matrix, user_ids, item_ids = encode_ratings(train_data)
+        count, user_item_count = user_cooccurrence_matrix(matrix)
+        super().__init__(train_data, count, user_item_count, user_ids, topk=topk)
+
+        # 每个物品被哪些用户(行号)评价过
+        behavior = (matrix > 0).tocsc()
+        behavior.eliminate_zeros()
+        self.item_users = {item: set(behavior.indices[behavior.indptr[j]:behavior.indptr[j + 1]].tolist())
+                           for j, item in enumerate(item_ids)}
+
+    def weighted_outer(self, user_sets):
+        """
+        sum_i w_i * x_i * x_i^T，x_i是第i个用户集合的指示向量，w_i = 1 / log(1 + |x_i|)
+        :param user_sets: 用户行号集合的列表
+        :return: 稀疏矩阵
+        """
+        sizes = np.array([len(users) for users in user_sets], dtype=np.float64)
+        rows = np.fromiter((u for users in user_sets for u in users), dtype=np.int64, count=int(sizes.sum()))
+        cols = np.repeat(np.arange(len(user_sets)), sizes.astype(np.int64))
+        x = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(self.count.shape[0], len(user_sets)))
+        weight = np.zeros_like(sizes)
+        np.divide(1.0, np.log1p(sizes), out=weight, where=sizes > 0)
+        return x @ sp.diags(weight) @ x.T
+
+    def update(self, events):
+        """
+        增量更新，受影响物品的新旧用户集合分别作为一列，同现值的变化是两个按IUF加权的外积之差
+        :param events: [(user, item, rating)]
+        :return: 近邻发生变化的用户集合
+        """
+        events = list(events)
+        new_rows = self.add_ids(user for user, _, _ in events)
+        id_index = self.index.id_index
+        # 本批事件修改之前每个物品的用户集合
+        before = dict()
+        changed_rows = set()
+        for user, item, delta in self.apply_events(events):
+            u = id_index[user]
+            users = self.item_users.setdefault(item, set())
+            before.setdefault(item, set(users))
+            if delta > 0:
+                users.add(u)
+            else:
+                users.discard(u)
+            self.total[u] += delta
+            changed_rows.add(u)
+
+        old_sets = list(before.values())
+        new_sets = [self.item_users[item] for item in before.keys()]
+        self.add_count(self.weighted_outer(new_sets) - self.weighted_outer(old_sets))
+        rows = np.fromiter((u for users in old_sets + new_sets for u in users), dtype=np.int64)
+        return self.finish_update(np.concatenate([rows, new_rows]), changed_rows)
@@ -10,31 +10,102 @@
 
 import random
 import math
-import os
 import json
 import codecs
 
 from logger_toolkit import get_logger
+from batch_recommend import remap_columns, select_rows, select_top_n
+from incremental_similarity import IncrementalItemSimilarity
+from neighbor_index import NeighborIndex
+from parallel_evaluate import evaluate_precision_grid
+from ratings_loader import load_ratings
+from similarity_cache import SimilarityCache
+from similarity_store import save_neighbor_index, load_neighbor_index, import_json
+from sparse_similarity import encode_ratings, item_similarity_matrix, similarity_to_dict
 
 
 class ItemCFRec(object):
     """
     基于ItemCF算法的电影推荐系统
     """
-    def __init__(self, datafile, ratio, logger=None):
+    def __init__(self, datafile, ratio, logger=None, engine='dict', topk=50, sim_format='bin', loader='stream'):
         self.logger = get_logger('user_cf_recommend')
         if logger is not None:
             self.logger = logger
 
+        # 相似度计算引擎，dict: 嵌套字典逐对计数，sparse: 稀疏矩阵乘法
+        if engine not in ('dict', 'sparse'):
+            raise ValueError(f'不支持的相似度计算引擎: {engine}')
+        self.engine = engine
+        # 相似度文件格式，bin: 可以通过numpy.memmap打开的二进制近邻索引，json: {id: {id: weight}}形式的JSON
+        if sim_format not in ('bin', 'json'):
+            raise ValueError(f'不支持的相似度文件格式: {sim_format}')
+        self.sim_format = sim_format
+
         # 原始数据路径文件
         self.datafile = datafile
         # 测试集与训练集的比例
         self.ratio = ratio
-        self.item_sim_file = 'data/item_sim.json'
-        self.data = self.load_data()
+        self.item_sim_file = f'data/item_sim.{sim_format}'
+        # 评分数据加载方式，stream: 分块解析为列式数据并同时切分，lines: 逐行读入内存后再切分
+        if loader not in ('stream', 'lines'):
+            raise ValueError(f'不支持的数据加载方式: {loader}')
+        self.loader = loader
+        # 列式存储的训练集和测试集，只有stream方式下才有
+        self.train_ratings, self.test_ratings = None, None
+        self.data = None
+
+        # 训练集与测试集的切分参数(k, seed, M)
+        self.split_args = (3, 47, 9)
+        # {user: {item: rating}}形式的训练集和测试集，stream方式下第一次使用时才从列式数据构建
+        self._train_data, self._test_data = self.load_train_test()
+        # 每个物品只保留最相似的topk个物品，完整的相似度字典在构建索引后即释放
+        self.topk = topk
+        self.item_neighbors = self.load_item_neighbors()
+        # 增量更新相似度用的同现矩阵，第一次调用update时构建
+        self.incremental = None
+        # 批量推荐用到的历史评分矩阵(列按近邻索引中的物品编码)和用户 -> 行号，第一次使用时构建
+        self.history, self.history_users = None, None
+
+    @property
+    def train_data(self):
+        """
+        {user: {item: rating}}形式的训练集
+        """
+        if self._train_data is None:
+            self._train_data = self.train_ratings.to_dict()
+        return self._train_data
+
+    @train_data.setter
+    def train_data(self, value):
+        self._train_data = value
 
-        self.train_data, self.test_data = self.split_data(3, 47)
-        self.item_sim = self.item_similarity_best()
+    @property
+    def test_data(self):
+        """
+        {user: {item: rating}}形式的测试集
+        """
+        if self._test_data is None:
+            self._test_data = self.test_ratings.to_dict()
+        return self._test_data
+
+    @test_data.setter
+    def test_data(self, value):
+        self._test_data = value
+
+    def load_train_test(self):
+        """
+        加载评分数据并切分训练集和测试集，两种加载方式的切分结果完全一致
+        stream方式下只保留列式数据，字典形式的训练集和测试集在第一次使用时才构建
+        :return: (train, test)，stream方式下为(None, None)
+        """
+        if self.loader == 'stream':
+            self.logger.info('分块加载数据并切分训练集与测试集...')
+            self.train_ratings, self.test_ratings = load_ratings(self.datafile, self.split_args)
+            return None, None
+
+        self.data = self.load_data()
+        return self.split_data(*self.split_args)
 
     # 加载评分数据到data
     def load_data(self):
@@ -74,9 +145,8 @@ class ItemCFRec(object):
         :return:
         """
         self.logger.info('开始计算物品之间的相似度')
-        if os.path.exists(self.item_sim_file):
-            self.logger.info('物品相似度从文件加载')
-            item_sim = json.load(codecs.open(self.item_sim_file, mode='r'))
+        if self.engine == 'sparse':
+            item_sim = similarity_to_dict(*self.item_similarity_sparse())
         else:
             item_sim = dict()
             # 得到每个物品有多少用户产生过行为, 每个物品在多少用户中出现
@@ -110,23 +180,94 @@ class ItemCFRec(object):
                     # 物品i和j的相似度定义为：物品i和j共同出现的次数除以物品i出现的总次数
                     item_sim[i][j] = cuv / math.sqrt(item_user_count[i] * item_user_count[j])
 
-        self.logger.info(json.dumps(item_sim, indent=2, ensure_ascii=False))
-        json.dump(item_sim, codecs.open(self.item_sim_file, mode='w'))
-
         return item_sim
 
+    def item_similarity_sparse(self):
+        """
+        使用稀疏矩阵乘法计算item之间的相似度, 惩罚热门物品, 结果与item_similarity_best的字典实现一致
+        :return: (相似度矩阵, item_ids)，矩阵的行列都按item_ids编码
+        """
+        self.logger.info('使用稀疏矩阵计算物品之间的相似度')
+        matrix, _, item_ids = self.train_matrix()
+        return item_similarity_matrix(matrix), item_ids
+
+    def train_matrix(self):
+        """
+        训练集的用户-物品评分矩阵，优先使用列式训练集
+        :return: (matrix, user_ids, item_ids)
+        """
+        if self.train_ratings is not None:
+            return self.train_ratings.to_csr()
+        return encode_ratings(self.train_data)
+
+    def load_item_neighbors(self):
+        """
+        构建物品近邻索引
+        相似度文件与当前的数据文件、切分参数和算法参数一致时直接加载，否则重新计算并写入文件
+        :return:
+        """
+        cache = SimilarityCache(self.item_sim_file, self.datafile, params={
+            'algorithm': 'item_similarity_best',
+            'split': self.split_args,
+            # 两种引擎并列近邻的取舍不同，得到的近邻索引和相似度文件不能互相复用
+            'engine': self.engine,
+            # 二进制文件保存的是裁剪后的近邻索引，JSON文件保存的是完整的相似度
+            'topk': self.topk if self.sim_format == 'bin' else None,
+        })
+        if cache.is_valid():
+            self.logger.info('物品相似度从文件加载')
+            if self.sim_format == 'bin':
+                return load_neighbor_index(self.item_sim_file)
+            return import_json(self.item_sim_file, topk=self.topk)
+
+        cache.invalidate()
+        if self.engine == 'sparse':
+            # 稀疏引擎直接在相似度矩阵上按行取topk，只有JSON格式需要完整的相似度字典
+            sim, item_ids = self.item_similarity_sparse()
+            item_neighbors = NeighborIndex.from_csr(sim, item_ids, topk=self.topk)
+            item_sim = similarity_to_dict(sim, item_ids) if self.sim_format == 'json' else None
+        else:
+            item_sim = self.item_similarity_best()
+            item_neighbors = NeighborIndex.from_dict(item_sim, topk=self.topk)
+        if self.sim_format == 'bin':
+            save_neighbor_index(item_neighbors, self.item_sim_file)
+            cache.save()
+            return load_neighbor_index(self.item_sim_file)
+
+        with codecs.open(self.item_sim_file, mode='w', encoding='utf8') as fp:
+            json.dump(item_sim, fp)
+        cache.save()
+        return item_neighbors
+
+    def update(self, events):
+        """
+        增量更新：把新的评分写入训练集，只重算受影响的物品的相似度和近邻，近邻索引中也只替换这些行
+        第一次调用时根据当前训练集构建同现矩阵
+        :param events: 新的评分记录[(user, item, rating)]
+        :return: 近邻发生变化的物品集合
+        """
+        if self.incremental is None:
+            self.logger.info('构建增量更新用的同现矩阵...')
+            self.incremental = IncrementalItemSimilarity(self.train_data, topk=self.topk)
+        affected = self.incremental.update(events)
+        self.item_neighbors = self.incremental.to_index()
+        # 训练集已经变化，列式训练集和历史评分矩阵不再可用
+        self.train_ratings = None
+        self.history, self.history_users = None, None
+        return affected
+
     def recommend(self, user, k=8, nitems=40):
         """
         为用户进行推荐
         :param user: 用户
-        :param k: k个临近物品
+        :param k: k个临近物品，最多为topk个
         :param nitems: 总共返回n个物品
         :return:
         """
         result = dict()
         u_items = self.train_data.get(user, {})
         for i, pi in u_items.items():
-            for j, wj in sorted(self.item_sim[i].items(), key=lambda x: x[1], reverse=True)[0:k]:
+            for j, wj in self.item_neighbors.neighbors(i, k):
                 if j in u_items:
                     continue
                 result.setdefault(j, 0)
@@ -134,6 +275,58 @@ class ItemCFRec(object):
 
         return dict(sorted(result.items(), key=lambda x: x[1], reverse=True)[0:nitems])
 
+    def load_history(self):
+        """
+        构建训练集中所有用户的历史评分矩阵，列按近邻索引中的物品编码，只构建一次
+        :return: (history, user_index)
+        """
+        if self.history is None:
+            matrix, user_ids, item_ids = self.train_matrix()
+            self.history = remap_columns(matrix, item_ids, self.item_neighbors.id_index)
+            self.history_users = {user: row for row, user in enumerate(user_ids)}
+
+        return self.history, self.history_users
+
+    def batch_scores(self, users, ks):
+        """
+        计算一批用户在不同近邻个数下的推荐分数
+        近邻按相似度名次分层累加，k个近邻的分数 = 上一个k的分数 + 新增名次近邻的贡献，所有k共用一次top-max(k)近邻的计算
+        :param users: 用户列表
+        :param ks: 近邻个数列表
+        :return: (users, seen, item_ids, {k: scores})，seen是用户评价过的物品(CSR)，scores的列按item_ids编码
+        """
+        users = list(users)
+        history = select_rows(*self.load_history(), users)
+        scores_by_k = dict()
+        scores, start = None, 0
+        for k in sorted(set(ks)):
+            layer = history @ self.item_neighbors.to_csr(k, start=start)
+            scores = layer if scores is None else scores + layer
+            scores_by_k[k] = scores
+            start = k
+
+        return users, history, self.item_neighbors.ids, scores_by_k
+
+    def recommend_batch(self, users, k=8, nitems=40, batch_size=1000):
+        """
+        批量为用户进行推荐
+        用户历史评分矩阵乘以只保留k个近邻的物品相似度矩阵，一次得到一批用户对所有物品的推荐分数，
+        结果与逐个调用recommend一致(分数相同的物品顺序可能不同)
+        :param users: 用户列表
+        :param k: k个临近物品，最多为topk个
+        :param nitems: 每个用户返回n个物品
+        :param batch_size: 每批计算的用户数，决定了中间稠密矩阵的大小
+        :return: {user: {item: score}}
+        """
+        users = list(users)
+        result = dict()
+        for start in range(0, len(users), batch_size):
+            block, seen, item_ids, scores_by_k = self.batch_scores(users[start:start + batch_size], [k])
+            for user, (cols, scores) in zip(block, select_top_n(scores_by_k[k], seen, nitems)):
+                result[user] = dict(zip([item_ids[col] for col in cols.tolist()], scores.tolist()))
+
+        return result
+
     def precision(self, k=8, nitems=10):
         """
         计算准确率
@@ -144,9 +337,10 @@ class ItemCFRec(object):
         self.logger.info('开始计算准确率...')
         hit = 0
         precision = 0
+        results = self.recommend_batch(self.test_data.keys(), k=k, nitems=nitems)
         for user in self.test_data.keys():
             u_items = self.test_data.get(user, {})
-            result = self.recommend(user, k=k, nitems=nitems)
+            result = results[user]
             for item, rate in result.items():
                 if item in u_items:
                     hit += 1
@@ -155,12 +349,24 @@ class ItemCFRec(object):
 
         return hit / (precision * 1.0)
 
+    def precision_grid(self, ks, nitems_list, processes=None):
+        """
+        多进程计算(k, nitems)参数网格上的准确率，结果与逐个调用precision一致
+        :param ks: 近邻个数列表
+        :param nitems_list: 推荐物品个数列表
+        :param processes: 进程数，为None时使用全部CPU
+        :return: {(k, nitems): precision}
+        """
+        self.logger.info('开始并行计算准确率...')
+        # 在fork子进程之前构建历史评分矩阵，子进程直接共享
+        self.load_history()
+        return evaluate_precision_grid(self, self.test_data.keys(), ks, nitems_list, processes=processes)
+
 
 if __name__ == '__main__':
     logger = get_logger('item_cf_movie_recommend')
     ib = ItemCFRec(datafile='../../data/ml-1m/ratings.dat', ratio=[1, 9], logger=logger)
     logger.info(f'用户1进行推荐的结果如下: {ib.recommend("1")}')
-    for k in range(5, 11, 1):
-        for nitems in range(10, 22, 2):
-            precision = ib.precision(k=k, nitems=nitems)
-            logger.info(f'k = {k}, nitems={nitems}, precision is {precision}')
+    precisions = ib.precision_grid(ks=range(5, 11, 1), nitems_list=range(10, 22, 2))
+    for (k, nitems), precision in sorted(precisions.items()):
+        logger.info(f'k = {k}, nitems={nitems}, precision is {precision}')
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @File    : neighbor_index.py
+# @Software: PyCharm
+# @Description: 预先计算的TopK近邻索引
+
+import numpy as np
+import scipy.sparse as sp
+
+
+# 取topk时每块稠密矩阵的字节数上限
+TOP_K_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def top_k_rows(sim, topk=None):
+    """
+    对CSR矩阵的每一行按相似度从大到小(相同时按列号从小到大)排列，只保留前topk个元素
+    元素多于topk的行先在稠密块上用np.partition找到第topk大的值，只有不小于它的元素参与排序，
+    排序对全部行一次lexsort完成，不在Python中逐行排序
+    :param sim: 相似度矩阵
+    :param topk: 每行保留的个数，为None时保留全部
+    :return: (counts, indices, weights)，counts是每行保留的个数，indices和weights按行依次排列
+    """
+    sim = sp.csr_matrix(sim)
+    n_rows, n_cols = sim.shape
+    counts = np.diff(sim.indptr)
+    rows = np.repeat(np.arange(n_rows), counts)
+    indices, data = sim.indices, sim.data
+    if topk is not None:
+        threshold = np.full(n_rows, -np.inf)
+        heavy = np.flatnonzero(counts > topk)
+        block_rows = max(1, TOP_K_BLOCK_BYTES // (8 * max(n_cols, 1)))
+        for start in range(0, len(heavy), block_rows):
+            block = heavy[start:start + block_rows]
+            part = sim[block]
+            dense = np.full((len(block), n_cols), -np.inf)
+            dense[np.repeat(np.arange(len(block)), np.diff(part.indptr)), part.indices] = part.data
+            threshold[block] = np.partition(dense, n_cols - topk, axis=1)[:, n_cols - topk]
+        keep = data >= threshold[rows]
+        rows, indices, data = rows[keep], indices[keep], data[keep]
+        counts = np.bincount(rows, minlength=n_rows)
+
+    order = np.lexsort((indices, -data, rows))
+    if topk is not None:
+        # 排序后仍按行分组，每个元素在所在行中的名次
+        rank = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+        order = order[rank < topk]
+        counts = np.minimum(counts, topk)
+    return counts, indices[order], data[order]
+
+
+class NeighborIndex(object):
+    """
+    近邻索引，每个用户/物品只保存相似度最高的topk个近邻
+    采用CSR形式的平行数组存储:
+        indptr[r]:indptr[r+1]是第r行的近邻在indices和weights中的区间
+        indices是近邻的行号(int32)，weights是对应的相似度(float32)，每行按相似度从大到小排列
+    """
+    def __init__(self, ids, indptr, indices, weights):
+        super().__init__()
+        # 行号 -> 原始ID
+        self.ids = list(ids)
+        # 原始ID -> 行号
+        self.id_index = {key: row for row, key in enumerate(self.ids)}
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+
+    @classmethod
+    def from_dict(cls, sim, topk=None):
+        """
+        从{id: {id: weight}}形式的相似度字典构建近邻索引
+        :param sim: 相似度字典
+        :param topk: 每行保留的近邻个数，为None时保留全部近邻
+        :return:
+        """
+        ids = list(sim.keys())
+        id_index = {key: row for row, key in enumerate(ids)}
+        indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+        indices, weights = [], []
+        for row, key in enumerate(ids):
+            # 与原来recommend中的排序方式保持一致，相似度相同时保持字典中的顺序
+            related = sorted(sim[key].items(), key=lambda x: x[1], reverse=True)[0:topk]
+            for neighbor, weight in related:
+                if neighbor not in id_index:
+                    id_index[neighbor] = len(ids)
+                    ids.append(neighbor)
+                indices.append(id_index[neighbor])
+                weights.append(weight)
+            indptr[row + 1] = len(indices)
+
+        # 只作为近邻出现的ID没有近邻
+        indptr = np.concatenate([indptr, np.full(len(ids) + 1 - len(indptr), indptr[-1], dtype=np.int64)])
+        return cls(ids, indptr, np.asarray(indices, dtype=np.int32), np.asarray(weights, dtype=np.float32))
+
+    @classmethod
+    def from_csr(cls, sim, ids, topk=None):
+        """
+        从稀疏相似度矩阵构建近邻索引，按行向量化地取topk，不经过相似度字典
+        :param sim: 相似度矩阵，行列都按ids编码
+        :param ids: 行号 -> 原始ID
+        :param topk: 每行保留的近邻个数，为None时保留全部近邻
+        :return:
+        """
+        return cls.from_csr_blocks([sim], ids, topk=topk)
+
+    @classmethod
+    def from_csr_blocks(cls, blocks, ids, topk=None):
+        """
+        从按行分块的稀疏相似度矩阵构建近邻索引，每块取完topk后即可释放
+        :param blocks: 依次覆盖全部行的相似度矩阵块，列按ids编码
+        :param ids: 行号 -> 原始ID
+        :param topk: 每行保留的近邻个数，为None时保留全部近邻
+        :return:
+        """
+        counts, indices, weights = [], [], []
+        for block in blocks:
+            block_counts, block_indices, block_weights = top_k_rows(block, topk)
+            counts.append(block_counts)
+            indices.append(block_indices.astype(np.int32))
+            weights.append(block_weights.astype(np.float32))
+
+        counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+        if len(counts) != len(ids):
+            raise ValueError(f'相似度矩阵的行数{len(counts)}与ID个数{len(ids)}不一致')
+        indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int32)
+        weights = np.concatenate(weights) if weights else np.zeros(0, dtype=np.float32)
+        return cls(ids, indptr, indices, weights)
+
+    def add_ids(self, keys):
+        """
+        追加索引中还没有的ID，新的行没有近邻
+        :param keys: 用户/物品ID
+        :return:
+        """
+        for key in keys:
+            if key not in self.id_index:
+                self.id_index[key] = len(self.ids)
+                self.ids.append(key)
+        indptr = np.asarray(self.indptr)
+        missing = len(self.ids) + 1 - len(indptr)
+        if missing > 0:
+            self.indptr = np.concatenate([indptr, np.full(missing, indptr[-1], dtype=np.int64)])
+
+    def update_rows(self, rows, counts, indices, weights):
+        """
+        原地替换指定行的近邻，其余行的近邻直接按区间复制，不重新排序
+        :param rows: 需要替换的行号，不重复
+        :param counts: 每行新的近邻个数
+        :param indices: 新的近邻行号，按rows的顺序依次排列，每行已经按相似度从大到小排列
+        :param weights: 对应的相似度
+        :return:
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+        old_indptr = np.asarray(self.indptr)
+        old_counts = np.diff(old_indptr)
+        new_counts = old_counts.copy()
+        new_counts[rows] = counts
+        changed = np.zeros(len(old_counts), dtype=bool)
+        changed[rows] = True
+        indptr = np.concatenate([[0], np.cumsum(new_counts)]).astype(np.int64)
+
+        new_indices = np.empty(indptr[-1], dtype=np.int32)
+        new_weights = np.empty(indptr[-1], dtype=np.float32)
+        # 未变化的行整体平移到新的区间
+        entry_rows = np.repeat(np.arange(len(old_counts)), old_counts)
+        keep = ~changed[entry_rows]
+        target = np.arange(len(entry_rows))[keep] - old_indptr[entry_rows[keep]] + indptr[entry_rows[keep]]
+        new_indices[target] = np.asarray(self.indices)[keep]
+        new_weights[target] = np.asarray(self.weights)[keep]
+        # 替换的行写入各自的新区间
+        entry_rows = np.repeat(rows, counts)
+        offset = np.arange(len(entry_rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        new_indices[indptr[entry_rows] + offset] = indices
+        new_weights[indptr[entry_rows] + offset] = weights
+
+        self.indptr, self.indices, self.weights = indptr, new_indices, new_weights
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, key):
+        return key in self.id_index
+
+    @property
+    def nbytes(self):
+        """
+        近邻数组占用的字节数
+        """
+        return self.indptr.nbytes + self.indices.nbytes + self.weights.nbytes
+
+    def to_csr(self, k=None, start=0):
+        """
+        转换为相似度矩阵，每行只保留名次在[start, k)之间的近邻
+        :param k: 近邻个数，为None时保留索引中的全部近邻
+        :param start: 跳过每行前start个近邻，用于按名次分层累加
+        :return: CSR矩阵，行列都按ids编码
+        """
+        indptr = np.asarray(self.indptr)
+        counts = np.diff(indptr)
+        indices = np.asarray(self.indices)
+        weights = np.asarray(self.weights)
+        if k is not None or start > 0:
+            # 每个元素在所在行中的名次，行内已经按相似度从大到小排列
+            rank = np.arange(len(indices)) - np.repeat(indptr[:-1], counts)
+            keep = rank >= start
+            if k is not None:
+                keep &= rank < k
+            indices, weights = indices[keep], weights[keep]
+            counts = np.bincount(np.repeat(np.arange(len(counts)), counts)[keep], minlength=len(counts))
+            indptr = np.concatenate([[0], np.cumsum(counts)])
+
+        n = len(self.ids)
+        return sp.csr_matrix((weights, indices, indptr), shape=(n, n))
+
+    def to_dict(self):
+        """
+        转换为{id: {id: weight}}形式的相似度字典
+        :return:
+        """
+        return {key: dict(self.neighbors(key)) for key in self.ids}
+
+    def neighbors(self, key, k=None):
+        """
+        获取key最相似的k个近邻
+        :param key: 用户/物品ID
+        :param k: 近邻个数，为None或超过索引中保存的个数时返回全部保存的近邻
+        :return: [(neighbor, weight)]，按相似度从大到小排列，key不存在时返回空列表
+        """
+        row = self.id_index.get(key)
+        if row is None:
+            return []
+
+        start, end = self.indptr[row], self.indptr[row + 1]
+        if k is not None:
+            end = min(end, start + k)
+        ids = self.ids
+        return [(ids[col], weight) for col, weight in
+                zip(self.indices[start:end].tolist(), self.weights[start:end].tolist())]
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @File    : parallel_evaluate.py
+# @Software: PyCharm
+# @Description: 多进程计算(k, nitems)参数网格上的准确率
+
+import multiprocessing
+
+import numpy as np
+
+from batch_recommend import select_top_n
+
+# 子进程通过fork继承的推荐器和测试集，只读，避免每个任务都序列化一次相似度数据
+_recommender = None
+_test_data = None
+
+
+def _evaluate_shard(task):
+    """
+    计算一批用户在整个参数网格上的命中数
+    每个k只做一次TopN选取(取最大的nitems)，较小的nitems直接取前缀
+    :param task: (users, ks, nitems_list)
+    :return: {(k, nitems): hit}
+    """
+    users, ks, nitems_list = task
+    test_data = _test_data
+    max_nitems = max(nitems_list)
+    hits = {(k, nitems): 0 for k in ks for nitems in nitems_list}
+    users, seen, item_ids, scores_by_k = _recommender.batch_scores(users, ks)
+    for k, scores in scores_by_k.items():
+        for user, (cols, _) in zip(users, select_top_n(scores, seen, max_nitems)):
+            tu = test_data.get(user, {})
+            # cum_hits[n - 1]是前n个推荐结果中的命中数
+            cum_hits = np.cumsum([item_ids[col] in tu for col in cols.tolist()])
+            for nitems in nitems_list:
+                n = min(nitems, len(cum_hits))
+                if n > 0:
+                    hits[(k, nitems)] += int(cum_hits[n - 1])
+
+    return hits
+
+
+def evaluate_precision_grid(recommender, users, ks, nitems_list, processes=None, shard_size=500):
+    """
+    并行计算参数网格上的准确率，准确率 = 命中数 / (nitems * 用户数)，与recommender.precision一致
+    推荐器需要提供batch_scores(users, ks)和test_data，通过fork共享给子进程；
+    不支持fork的平台(Windows)或processes=1时在当前进程中计算
+    :param recommender: ItemCFRec或UserCFRec
+    :param users: 参与评估的用户
+    :param ks: 近邻个数列表
+    :param nitems_list: 推荐物品个数列表
+    :param processes: 进程数，为None时使用全部CPU
+    :param shard_size: 每个任务包含的用户数
+    :return: {(k, nitems): precision}
+    """
+    global _recommender, _test_data
+    users = list(users)
+    ks, nitems_list = sorted(set(ks)), sorted(set(nitems_list))
+    tasks = [(users[start:start + shard_size], ks, nitems_list) for start in range(0, len(users), shard_size)]
+
+    _recommender = recommender
+    # 测试集在fork之前构建好，子进程直接共享
+    _test_data = recommender.test_data
+    try:
+        if processes == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            results = [_evaluate_shard(task) for task in tasks]
+        else:
+            with multiprocessing.get_context('fork').Pool(processes=processes) as pool:
+                results = pool.map(_evaluate_shard, tasks)
+    finally:
+        _recommender, _test_data = None, None
+
+    precision = dict()
+    for k in ks:
+        for nitems in nitems_list:
+            hit = sum(result[(k, nitems)] for result in results)
+            precision[(k, nitems)] = hit / (nitems * len(users) * 1.0) if users else 0.0
+
+    return precision
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @File    : ratings_loader.py
+# @Software: PyCharm
+# @Description: 流式分块加载MovieLens评分数据(userid::itemid::rating::timestamp)，边加载边切分训练集和测试集
+
+import random
+
+import numpy as np
+import scipy.sparse as sp
+
+
+class RatingTable(object):
+    """
+    列式存储的评分数据
+    users/items是用户和物品的整数编码(int32)，ratings是评分(int8)
+    user_ids/item_ids是编码 -> 原始ID的映射，训练集和测试集共用同一套编码
+    """
+    def __init__(self, users, items, ratings, user_ids, item_ids):
+        super().__init__()
+        self.users = users
+        self.items = items
+        self.ratings = ratings
+        self.user_ids = user_ids
+        self.item_ids = item_ids
+
+    def __len__(self):
+        return len(self.ratings)
+
+    def to_csr(self):
+        """
+        构建用户-物品评分矩阵，只保留有评分记录的用户和物品
+        :return: (matrix, user_ids, item_ids)，与sparse_similarity.encode_ratings的返回值一致，ID为字符串
+        """
+        order, user_codes = self.dict_order()
+        # 物品按在to_dict的遍历顺序中第一次出现的顺序编码
+        item_codes, first = np.unique(self.items[order], return_index=True)
+        item_codes = item_codes[np.argsort(first)]
+        user_rows = np.empty(len(self.user_ids), dtype=np.int32)
+        user_rows[user_codes] = np.arange(len(user_codes))
+        item_cols = np.empty(len(self.item_ids), dtype=np.int32)
+        item_cols[item_codes] = np.arange(len(item_codes))
+        rows, cols = user_rows[self.users], item_cols[self.items]
+        # 同一用户对同一物品有多条记录时与to_dict一致，只保留最后一条
+        _, last = np.unique((rows.astype(np.int64) * len(item_codes) + cols)[::-1], return_index=True)
+        last = len(rows) - 1 - last
+        matrix = sp.csr_matrix(
+            (self.ratings[last].astype(np.float64), (rows[last], cols[last])),
+            shape=(len(user_codes), len(item_codes)))
+        return matrix, [str(one) for one in self.user_ids[user_codes]], [str(one) for one in self.item_ids[item_codes]]
+
+    def dict_order(self):
+        """
+        to_dict遍历记录的顺序：用户按在本表中第一次出现的顺序排列，同一用户的记录保持文件中的顺序(稳定排序)
+        :return: (order, user_codes)，order是记录的下标，user_codes是按第一次出现的顺序排列的用户编码
+        """
+        user_codes, first = np.unique(self.users, return_index=True)
+        user_codes = user_codes[np.argsort(first)]
+        rank = np.empty(len(self.user_ids), dtype=np.int64)
+        rank[user_codes] = np.arange(len(user_codes))
+        return np.argsort(rank[self.users], kind='stable'), user_codes
+
+    def distinct_users(self):
+        """
+        本表中出现过的用户，ID为字符串，顺序与to_dict的键一致
+        :return:
+        """
+        user_codes, first = np.unique(self.users, return_index=True)
+        return [str(one) for one in self.user_ids[user_codes[np.argsort(first)]]]
+
+    def to_dict(self):
+        """
+        转换为{user: {item: rating}}形式的字典，ID为字符串，与原来的split_data结果一致
+        :return:
+        """
+        result = dict()
+        # 用户按第一次出现的顺序、同一用户的记录按文件中的顺序排列，再按用户切段
+        order, _ = self.dict_order()
+        users, items, ratings = self.users[order], self.items[order], self.ratings[order]
+        bounds = np.flatnonzero(np.diff(users)) + 1
+        starts = np.concatenate([[0], bounds]).tolist()
+        ends = np.concatenate([bounds, [len(users)]]).tolist()
+        user_ids = self.user_ids.astype(str)
+        item_ids = self.item_ids.astype(str)
+        for start, end in zip(starts, ends):
+            if start == end:
+                continue
+            result[user_ids[users[start]]] = dict(zip(item_ids[items[start:end]].tolist(), ratings[start:end].tolist()))
+
+        return result
+
+
+class SplitSampler(object):
+    """
+    批量生成与random.seed(seed)之后逐条调用random.randint(0, M)完全相同的随机数序列
+    random模块和numpy的MT19937是同一个梅森旋转算法，把random的内部状态复制给numpy后，
+    按照random._randbelow的方式取高位并拒绝超出范围的值即可
+    """
+    def __init__(self, seed, M):
+        super().__init__()
+        _, internal, _ = random.Random(seed).getstate()
+        self.bit_generator = np.random.MT19937()
+        self.bit_generator.state = {
+            'bit_generator': 'MT19937',
+            'state': {'key': np.array(internal[:-1], dtype=np.uint32), 'pos': internal[-1]},
+        }
+        self.upper = M + 1
+        self.shift = 32 - self.upper.bit_length()
+        # 已经生成但还没有使用的随机数
+        self.pending = np.empty(0, dtype=np.int64)
+
+    def draw(self, n):
+        """
+        取接下来的n个随机数
+        :param n: 个数
+        :return:
+        """
+        parts = [self.pending]
+        count = len(self.pending)
+        while count < n:
+            raw = (self.bit_generator.random_raw(max(n - count, 1024)) >> self.shift).astype(np.int64)
+            accepted = raw[raw < self.upper]
+            parts.append(accepted)
+            count += len(accepted)
+
+        values = np.concatenate(parts)
+        self.pending = values[n:]
+        return values[:n]
+
+
+class IdEncoder(object):
+    """
+    把原始的整数ID按第一次出现的顺序编码为连续的int32
+    """
+    def __init__(self):
+        super().__init__()
+        self.lookup = np.full(1024, -1, dtype=np.int32)
+        self.ids = np.empty(0, dtype=np.int64)
+
+    def encode(self, raw):
+        if raw.min() < 0:
+            raise ValueError('ID必须为非负整数')
+        max_id = raw.max()
+        if max_id >= len(self.lookup):
+            lookup = np.full(max(max_id + 1, 2 * len(self.lookup)), -1, dtype=np.int32)
+            lookup[:len(self.lookup)] = self.lookup
+            self.lookup = lookup
+
+        unknown = raw[self.lookup[raw] < 0]
+        if len(unknown) > 0:
+            new_ids, first = np.unique(unknown, return_index=True)
+            new_ids = new_ids[np.argsort(first)]
+            self.lookup[new_ids] = np.arange(len(self.ids), len(self.ids) + len(new_ids), dtype=np.int32)
+            self.ids = np.concatenate([self.ids, new_ids])
+
+        return self.lookup[raw]
+
+
+def iter_chunks(datafile, chunk_bytes):
+    """
+    按块读取文件，每块都在换行符处截断
+    :param datafile: 文件路径
+    :param chunk_bytes: 每块的大致字节数
+    :return:
+    """
+    tail = b''
+    with open(datafile, mode='rb') as fp:
+        while True:
+            block = fp.read(chunk_bytes)
+            if not block:
+                break
+            block = tail + block
+            cut = block.rfind(b'\n') + 1
+            tail = block[cut:]
+            if cut > 0:
+                yield block[:cut]
+
+    if tail.strip():
+        yield tail
+
+
+def load_ratings(datafile, split_args, chunk_bytes=1 << 24):
+    """
+    流式分块加载评分数据并切分训练集和测试集，切分结果与split_data(k, seed, M)完全一致
+    :param datafile: 评分文件路径，每行为userid::itemid::rating::timestamp
+    :param split_args: 切分参数(k, seed, M)，random.randint(0, M) == k的记录进入测试集
+    :param chunk_bytes: 每次读取的字节数
+    :return: (train, test)，两个RatingTable
+    """
+    k, seed, M = split_args
+    sampler = SplitSampler(seed, M)
+    user_encoder, item_encoder = IdEncoder(), IdEncoder()
+    train_parts, test_parts = [], []
+    for chunk in iter_chunks(datafile, chunk_bytes):
+        # 把多字符分隔符换成空白后交给numpy的C解析器
+        values = np.fromstring(chunk.replace(b'::', b' ').decode('ascii'), dtype=np.int64, sep=' ')
+        if len(values) % 4 != 0:
+            raise ValueError(f'评分文件格式错误: {datafile}')
+        values = values.reshape(-1, 4)
+        columns = (user_encoder.encode(values[:, 0]), item_encoder.encode(values[:, 1]), values[:, 2].astype(np.int8))
+
+        is_test = sampler.draw(len(values)) == k
+        test_parts.append([column[is_test] for column in columns])
+        train_parts.append([column[~is_test] for column in columns])
+
+    def concat(parts, index, dtype):
+        return np.concatenate([part[index] for part in parts]) if parts else np.empty(0, dtype=dtype)
+
+    tables = []
+    for parts in (train_parts, test_parts):
+        tables.append(RatingTable(
+            concat(parts, 0, np.int32), concat(parts, 1, np.int32), concat(parts, 2, np.int8),
+            user_encoder.ids, item_encoder.ids))
+
+    return tables[0], tables[1]
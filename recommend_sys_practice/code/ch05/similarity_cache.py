@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @File    : similarity_cache.py
+# @Software: PyCharm
+# @Description: 相似度文件的缓存校验，输入数据、切分参数或算法变化时重新计算
+
+import os
+import json
+import codecs
+import hashlib
+
+# 缓存元数据格式版本，元数据结构或相似度文件格式不兼容时加1
+CACHE_VERSION = 2
+
+
+def file_fingerprint(path, known=None):
+    """
+    计算数据文件的指纹
+    大小和修改时间与known一致时直接沿用known中的哈希值，避免每次启动都完整读一遍数据文件
+    :param path: 数据文件路径
+    :param known: 之前计算的指纹
+    :return: {'size': 文件大小, 'mtime_ns': 修改时间, 'sha1': 文件内容的SHA1}
+    """
+    stat = os.stat(path)
+    fingerprint = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if known is not None and known.get('size') == stat.st_size and known.get('mtime_ns') == stat.st_mtime_ns:
+        fingerprint['sha1'] = known.get('sha1')
+        return fingerprint
+
+    sha1 = hashlib.sha1()
+    with open(path, mode='rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            sha1.update(chunk)
+    fingerprint['sha1'] = sha1.hexdigest()
+    return fingerprint
+
+
+class SimilarityCache(object):
+    """
+    相似度文件的缓存元数据，保存在相似度文件旁边的<cache_file>.meta.json中
+    只有数据文件内容、切分参数和算法参数都一致时才复用已有的相似度文件
+    """
+    def __init__(self, cache_file, datafile, params):
+        """
+        :param cache_file: 相似度文件路径
+        :param datafile: 原始数据文件路径
+        :param params: 影响计算结果的参数，例如切分参数、算法变体，必须可以JSON序列化
+        """
+        super().__init__()
+        self.cache_file = cache_file
+        self.meta_file = f'{cache_file}.meta.json'
+        self.datafile = datafile
+        # 经过一次JSON序列化，保证与从文件中读出来的结构可以直接比较
+        self.params = json.loads(json.dumps(params))
+
+    def load_meta(self):
+        if not os.path.exists(self.meta_file):
+            return None
+        try:
+            with codecs.open(self.meta_file, mode='r', encoding='utf8') as fr:
+                return json.load(fr)
+        except ValueError:
+            return None
+
+    def is_valid(self):
+        """
+        判断已有的相似度文件是否可以复用
+        :return:
+        """
+        if not os.path.exists(self.cache_file):
+            return False
+        meta = self.load_meta()
+        if meta is None or meta.get('version') != CACHE_VERSION or meta.get('params') != self.params:
+            return False
+
+        known = meta.get('data')
+        if not known:
+            return False
+        fingerprint = file_fingerprint(self.datafile, known)
+        if fingerprint['sha1'] != known.get('sha1'):
+            return False
+        if fingerprint != known:
+            # 内容没变只是修改时间变了，更新元数据以便下次跳过哈希计算
+            self.save(fingerprint)
+        return True
+
+    def save(self, fingerprint=None):
+        """
+        相似度文件写入完成后保存对应的元数据
+        :param fingerprint: 数据文件指纹，为None时重新计算
+        :return:
+        """
+        if fingerprint is None:
+            fingerprint = file_fingerprint(self.datafile)
+        meta = {'version': CACHE_VERSION, 'params': self.params, 'data': fingerprint}
+        tmp_path = f'{self.meta_file}.tmp.{os.getpid()}'
+        with codecs.open(tmp_path, mode='w', encoding='utf8') as fp:
+            json.dump(meta, fp, indent=2)
+        os.replace(tmp_path, self.meta_file)
+
+    def invalidate(self):
+        """
+        删除元数据，下次启动时重新计算相似度
+        :return:
+        """
+        if os.path.exists(self.meta_file):
+            os.remove(self.meta_file)
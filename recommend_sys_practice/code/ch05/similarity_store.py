@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @File    : similarity_store.py
+# @Software: PyCharm
+# @Description: 相似度矩阵的二进制存储，可以通过numpy.memmap直接打开
+
+import json
+import codecs
+
+import numpy as np
+
+from array_store import save_arrays, open_arrays
+from neighbor_index import NeighborIndex
+
+# 近邻索引保存为array_store格式的文件:
+#     arrays: indptr(int64[n_rows + 1]) indices(int32[nnz]) weights(float32[nnz])
+#     meta:   {'kind': 'neighbor_index', 'ids': 行号 -> ID的字符串列表}
+KIND = 'neighbor_index'
+
+
+def save_neighbor_index(index, path):
+    """
+    将近邻索引保存为二进制文件，先写临时文件再替换，避免其他进程读到写了一半的文件
+    :param index: NeighborIndex
+    :param path: 文件路径
+    :return:
+    """
+    arrays = {
+        'indptr': np.asarray(index.indptr, dtype=np.int64),
+        'indices': np.asarray(index.indices, dtype=np.int32),
+        'weights': np.asarray(index.weights, dtype=np.float32),
+    }
+    save_arrays(path, arrays, meta={'kind': KIND, 'ids': [str(key) for key in index.ids]})
+
+
+def load_neighbor_index(path, mmap=True):
+    """
+    打开二进制格式的近邻索引
+    :param path: 文件路径
+    :param mmap: 为True时数组通过numpy.memmap映射，多个进程可以共享同一份物理内存
+    :return: NeighborIndex
+    """
+    arrays, meta = open_arrays(path, mmap=mmap)
+    if meta.get('kind') != KIND:
+        raise ValueError(f'不是相似度矩阵文件: {path}')
+    return NeighborIndex(meta['ids'], arrays['indptr'], arrays['indices'], arrays['weights'])
+
+
+def export_json(index, path):
+    """
+    将近邻索引导出为{id: {id: weight}}形式的JSON文件
+    :param index: NeighborIndex
+    :param path: JSON文件路径
+    :return:
+    """
+    with codecs.open(path, mode='w', encoding='utf8') as fw:
+        json.dump(index.to_dict(), fw)
+
+
+def import_json(path, topk=None):
+    """
+    从{id: {id: weight}}形式的JSON文件构建近邻索引
+    :param path: JSON文件路径
+    :param topk: 每行保留的近邻个数，为None时保留全部近邻
+    :return: NeighborIndex
+    """
+    with codecs.open(path, mode='r', encoding='utf8') as fr:
+        return NeighborIndex.from_dict(json.load(fr), topk=topk)
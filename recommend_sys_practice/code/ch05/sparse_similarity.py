@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# @File    : sparse_similarity.py
+# @Software: PyCharm
+# @Description: 基于稀疏矩阵运算的相似度计算
+
+import numpy as np
+import scipy.sparse as sp
+
+# 分块计算用户相似度时，每块稀疏相似度矩阵的字节数上限
+SIMILARITY_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def encode_ratings(train_data):
+    """
+    将{user: {item: rating}}形式的训练集编码为整数ID，并构建用户-物品CSR矩阵
+    :param train_data: 训练集
+    :return: (matrix, user_ids, item_ids)，matrix[u, i]是用户user_ids[u]对物品item_ids[i]的评分
+    """
+    user_ids = list(train_data.keys())
+    # 物品ID -> 列号，按物品第一次出现的顺序编码
+    item_index = dict()
+    rows, cols, values = [], [], []
+    for u, items in enumerate(train_data.values()):
+        for item, rating in items.items():
+            rows.append(u)
+            cols.append(item_index.setdefault(item, len(item_index)))
+            values.append(rating)
+
+    matrix = sp.csr_matrix(
+        (np.asarray(values, dtype=np.float64),
+         (np.asarray(rows, dtype=np.int32), np.asarray(cols, dtype=np.int32))),
+        shape=(len(user_ids), len(item_index)))
+    return matrix, user_ids, list(item_index.keys())
+
+
+def item_cooccurrence_matrix(matrix):
+    """
+    计算物品之间的同现矩阵
+    :param matrix: 用户-物品评分矩阵(CSR)
+    :return: (count, item_user_count)，count[i, j]是物品i和物品j共同出现的次数(CSR，对角线和为0的元素不存储)，
+             item_user_count[i]是物品i在多少用户中出现
+    """
+    # 只有评分大于0才算用户对物品产生过行为
+    behavior = (matrix > 0).astype(np.float64)
+    count = (behavior.T @ behavior).tocsr()
+    count = count - sp.diags(count.diagonal())
+    count.eliminate_zeros()
+
+    item_user_count = np.asarray(behavior.sum(axis=0)).ravel()
+    return count.tocsr(), item_user_count
+
+
+def item_similarity_matrix(matrix):
+    """
+    计算物品之间的相似度, 惩罚热门物品
+    w_ij = |N(i) ∩ N(j)| / sqrt(|N(i)| * |N(j)|)，其中N(i)是对物品i有正向评分的用户集合
+    :param matrix: 用户-物品评分矩阵(CSR)
+    :return: 物品-物品相似度矩阵(CSR)，对角线和为0的元素不存储
+    """
+    count, item_user_count = item_cooccurrence_matrix(matrix)
+    norm = np.zeros_like(item_user_count)
+    np.divide(1.0, np.sqrt(item_user_count), out=norm, where=item_user_count > 0)
+
+    item_sim = sp.diags(norm) @ count @ sp.diags(norm)
+    return item_sim.tocsr()
+
+
+def _user_behavior(matrix):
+    """
+    用户行为矩阵和IUF权重
+    :param matrix: 用户-物品评分矩阵(CSR)
+    :return: (behavior, iuf, user_item_count)，iuf[i] = 1 / log(1 + |N(i)|)，user_item_count[u]是用户u评价过的物品个数
+    """
+    behavior = (matrix > 0).astype(np.float64).tocsr()
+    # 每个物品被多少用户评价过，热门物品的权重更低
+    item_user_count = np.asarray(behavior.sum(axis=0)).ravel()
+    iuf = np.zeros_like(item_user_count)
+    np.divide(1.0, np.log1p(item_user_count), out=iuf, where=item_user_count > 0)
+
+    user_item_count = np.asarray(behavior.sum(axis=1)).ravel()
+    return behavior, iuf, user_item_count
+
+
+def user_cooccurrence_matrix(matrix):
+    """
+    计算用户之间按IUF加权的同现矩阵
+    C = X · diag(w) · X^T, w_i = 1 / log(1 + |N(i)|)
+    :param matrix: 用户-物品评分矩阵(CSR)
+    :return: (count, user_item_count)，count是同现矩阵(CSR，对角线和为0的元素不存储)，
+             user_item_count[u]是用户u评价过的物品个数
+    """
+    behavior, iuf, user_item_count = _user_behavior(matrix)
+    count = (behavior @ sp.diags(iuf) @ behavior.T).tocsr()
+    count = count - sp.diags(count.diagonal())
+    count.eliminate_zeros()
+
+    return count.tocsr(), user_item_count
+
+
+def user_similarity_matrix(matrix):
+    """
+    计算用户之间的相似度, 惩罚热门物品(IUF)
+    w_uv = C_uv / sqrt(|N(u)| * |N(v)|)，C为user_cooccurrence_matrix的同现矩阵，N(u)是用户u有正向评分的物品集合
+    :param matrix: 用户-物品评分矩阵(CSR)
+    :return: 用户-用户相似度矩阵(CSR)，对角线和为0的元素不存储
+    """
+    count, user_item_count = user_cooccurrence_matrix(matrix)
+    norm = np.zeros_like(user_item_count)
+    np.divide(1.0, np.sqrt(user_item_count), out=norm, where=user_item_count > 0)
+
+    user_sim = sp.diags(norm) @ count @ sp.diags(norm)
+    return user_sim.tocsr()
+
+
+def user_similarity_blocks(matrix, topk=None, block_bytes=SIMILARITY_BLOCK_BYTES):
+    """
+    按用户分块计算相似度，不构建完整的用户-用户矩阵，相似度与user_similarity_matrix一致
+    每块用稀疏矩阵乘稀疏矩阵得到该块用户与全部用户的相似度，只计算有共同物品的用户对，总计算量为Σ|N(i)|²，
+    再对每行按相似度从大到小(相同时按列号从小到大)只保留前topk个元素，与NeighborIndex.from_csr_blocks的取舍一致
+    :param matrix: 用户-物品评分矩阵(CSR)
+    :param topk: 每行保留的近邻个数，为None时保留全部相似度大于0的元素
+    :param block_bytes: 每块稀疏相似度矩阵的字节数上限，按每行非零元素个数的上界估计
+    :return: 生成器，依次产生覆盖全部用户的相似度矩阵块(CSR)，列按用户编码
+    """
+    behavior, iuf, user_item_count = _user_behavior(matrix)
+    norm = np.zeros_like(user_item_count)
+    np.divide(1.0, np.sqrt(user_item_count), out=norm, where=user_item_count > 0)
+
+    n_users = behavior.shape[0]
+    weighted = (behavior @ sp.diags(iuf)).tocsr()
+    behavior_t = behavior.T.tocsr()
+    # 用户u的相似度行最多有min(Σ|N(i)|, 用户数)个非零元素，每个元素占8字节的值和4字节的列号
+    item_user_count = np.asarray(behavior.sum(axis=0)).ravel()
+    row_nnz = np.minimum(behavior @ item_user_count, n_users)
+    bounds = np.cumsum(row_nnz)
+    max_nnz = max(1, block_bytes // 12)
+    start = 0
+    while start < n_users:
+        base = bounds[start - 1] if start > 0 else 0
+        end = max(start + 1, int(np.searchsorted(bounds, base + max_nnz, side='right')))
+        # sim[r, v]是用户start + r与用户v按IUF加权的同现次数
+        sim = (sp.diags(norm[start:end]) @ (weighted[start:end] @ behavior_t) @ sp.diags(norm)).tocoo()
+        keep = (sim.data > 0) & (sim.col != sim.row + start)
+        rows, cols, data = sim.row[keep], sim.col[keep], sim.data[keep]
+        if topk is not None:
+            order = np.lexsort((cols, -data, rows))
+            counts = np.bincount(rows, minlength=end - start)
+            # 排序后仍按行分组，每个元素在所在行中的名次
+            rank = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+            order = order[rank < topk]
+            rows, cols, data = rows[order], cols[order], data[order]
+        yield sp.csr_matrix((data, (rows, cols)), shape=(end - start, n_users))
+        start = end
+
+
+def similarity_to_dict(sim, ids):
+    """
+    将相似度矩阵转换为{id: {id: weight}}形式的字典
+    :param sim: 相似度矩阵(CSR)，行列使用同一套ID编码
+    :param ids: 行号/列号 -> 原始ID
+    :return: 相似度字典，每个ID都有一行，没有相似对象时为空字典
+    """
+    result = dict()
+    indptr, indices, data = sim.indptr, sim.indices, sim.data
+    for row, key in enumerate(ids):
+        start, end = indptr[row], indptr[row + 1]
+        result[key] = dict(zip([ids[col] for col in indices[start:end]], data[start:end].tolist()))
+
+    return result
@@ -11,25 +11,97 @@
 import random
 import math
 import json
-import os
 import codecs
 
 from logger_toolkit import get_logger
+from batch_recommend import select_rows, select_top_n
+from incremental_similarity import IncrementalUserSimilarity
+from neighbor_index import NeighborIndex
+from parallel_evaluate import evaluate_precision_grid
+from ratings_loader import load_ratings
+from similarity_cache import SimilarityCache
+from similarity_store import save_neighbor_index, load_neighbor_index, import_json
+from sparse_similarity import encode_ratings, user_similarity_matrix, user_similarity_blocks, similarity_to_dict
 
 
 class UserCFRec(object):
     """
     基于UserCF算法的电影推荐系统
     """
-    def __init__(self, datafile, logger=None):
+    def __init__(self, datafile, logger=None, engine='dict', topk=50, sim_format='bin', loader='stream'):
         self.logger = get_logger('user_cf_recommend')
         if logger is not None:
             self.logger = logger
+
+        # 相似度计算引擎，dict: 倒排表逐对计数，sparse: 稀疏矩阵乘法
+        if engine not in ('dict', 'sparse'):
+            raise ValueError(f'不支持的相似度计算引擎: {engine}')
+        self.engine = engine
+        # 相似度文件格式，bin: 可以通过numpy.memmap打开的二进制近邻索引，json: {id: {id: weight}}形式的JSON
+        if sim_format not in ('bin', 'json'):
+            raise ValueError(f'不支持的相似度文件格式: {sim_format}')
+        self.sim_format = sim_format
+        self.user_sim_file = f'data/user_sim.{sim_format}'
         self.datafile = datafile
-        self.data = self.load_data()
+        # 评分数据加载方式，stream: 分块解析为列式数据并同时切分，lines: 逐行读入内存后再切分
+        if loader not in ('stream', 'lines'):
+            raise ValueError(f'不支持的数据加载方式: {loader}')
+        self.loader = loader
+        # 列式存储的训练集和测试集，只有stream方式下才有
+        self.train_ratings, self.test_ratings = None, None
+        self.data = None
+
+        # 训练集与测试集的切分参数(k, seed, M)
+        self.split_args = (3, 47, 8)
+        # {user: {item: rating}}形式的训练集和测试集，stream方式下第一次使用时才从列式数据构建
+        self._train_data, self._test_data = self.load_train_test()
+        # 每个用户只保留最相似的topk个用户，完整的相似度字典在构建索引后即释放
+        self.topk = topk
+        self.user_neighbors = self.load_user_neighbors()
+        # 增量更新相似度用的同现矩阵，第一次调用update时构建
+        self.incremental = None
+        # 批量推荐用到的历史评分矩阵，第一次使用时构建
+        self.history, self.history_items = None, None
+
+    @property
+    def train_data(self):
+        """
+        {user: {item: rating}}形式的训练集
+        """
+        if self._train_data is None:
+            self._train_data = self.train_ratings.to_dict()
+        return self._train_data
+
+    @train_data.setter
+    def train_data(self, value):
+        self._train_data = value
+
+    @property
+    def test_data(self):
+        """
+        {user: {item: rating}}形式的测试集
+        """
+        if self._test_data is None:
+            self._test_data = self.test_ratings.to_dict()
+        return self._test_data
+
+    @test_data.setter
+    def test_data(self, value):
+        self._test_data = value
+
+    def load_train_test(self):
+        """
+        加载评分数据并切分训练集和测试集，两种加载方式的切分结果完全一致
+        stream方式下只保留列式数据，字典形式的训练集和测试集在第一次使用时才构建
+        :return: (train, test)，stream方式下为(None, None)
+        """
+        if self.loader == 'stream':
+            self.logger.info('分块加载数据并切分训练集与测试集...')
+            self.train_ratings, self.test_ratings = load_ratings(self.datafile, self.split_args)
+            return None, None
 
-        self.train_data, self.test_data = self.split_data(3, 47)
-        self.user_sim = self.user_similarity_best()
+        self.data = self.load_data()
+        return self.split_data(*self.split_args)
 
     # 加载评分数据到data
     def load_data(self):
@@ -69,10 +141,8 @@ class UserCFRec(object):
         :return:
         """
         self.logger.info('开始计算用户之间的相似度...')
-        if os.path.exists('data/user_sim.json'):
-            self.logger.info('用户相似度从文件加载...')
-            user_sim = json.load(codecs.open('data/user_sim.json', mode='r', encoding='utf8'))
-            self.logger.info('用户相似度加载完成')
+        if self.engine == 'sparse':
+            user_sim = similarity_to_dict(*self.user_similarity_sparse())
         else:
             # 得到每一个item被哪些user评价过
             item_users = dict()
@@ -110,16 +180,109 @@ class UserCFRec(object):
                     # user_sim[u][v]是用户u和用户v的兴趣相似度
                     user_sim[u][v] = cuv / math.sqrt(user_item_count[u] * user_item_count[v])
 
-            json.dump(user_sim, codecs.open('data/user_sim.json', mode='w'))
-            self.logger.info('用户相似度计算完成')
+        self.logger.info('用户相似度计算完成')
 
         return user_sim
 
+    def user_similarity_sparse(self):
+        """
+        使用稀疏矩阵乘法计算用户之间的相似度, 惩罚热门物品, 结果与user_similarity_best的倒排表实现一致
+        :return: (相似度矩阵, user_ids)，矩阵的行列都按user_ids编码
+        """
+        self.logger.info('使用稀疏矩阵计算用户之间的相似度...')
+        matrix, user_ids, _ = self.train_matrix()
+        return user_similarity_matrix(matrix), user_ids
+
+    def user_neighbors_sparse(self):
+        """
+        按用户分块计算相似度，每块只保留topk个近邻后写入近邻索引，不构建完整的用户-用户相似度矩阵
+        :return: NeighborIndex
+        """
+        self.logger.info('使用稀疏矩阵分块计算用户之间的相似度...')
+        matrix, user_ids, _ = self.train_matrix()
+        return NeighborIndex.from_csr_blocks(user_similarity_blocks(matrix, topk=self.topk), user_ids, topk=self.topk)
+
+    def train_matrix(self):
+        """
+        训练集的用户-物品评分矩阵，优先使用列式训练集
+        :return: (matrix, user_ids, item_ids)
+        """
+        if self.train_ratings is not None:
+            return self.train_ratings.to_csr()
+        return encode_ratings(self.train_data)
+
+    def train_users(self):
+        """
+        训练集中的用户，字典形式的训练集还没有构建时直接取列式训练集中的用户
+        :return: 用户列表
+        """
+        if self._train_data is None:
+            return self.train_ratings.distinct_users()
+        return list(self._train_data.keys())
+
+    def load_user_neighbors(self):
+        """
+        构建用户近邻索引
+        相似度文件与当前的数据文件、切分参数和算法参数一致时直接加载，否则重新计算并写入文件
+        :return:
+        """
+        cache = SimilarityCache(self.user_sim_file, self.datafile, params={
+            'algorithm': 'user_similarity_best',
+            'split': self.split_args,
+            # 两种引擎并列近邻的取舍不同，得到的近邻索引和相似度文件不能互相复用
+            'engine': self.engine,
+            # 二进制文件保存的是裁剪后的近邻索引，JSON文件保存的是完整的相似度
+            'topk': self.topk if self.sim_format == 'bin' else None,
+        })
+        if cache.is_valid():
+            self.logger.info('用户相似度从文件加载')
+            if self.sim_format == 'bin':
+                return load_neighbor_index(self.user_sim_file)
+            return import_json(self.user_sim_file, topk=self.topk)
+
+        cache.invalidate()
+        if self.engine == 'sparse' and self.sim_format == 'bin':
+            user_sim, user_neighbors = None, self.user_neighbors_sparse()
+        elif self.engine == 'sparse':
+            # JSON格式保存的是完整的相似度，需要完整的相似度矩阵
+            sim, user_ids = self.user_similarity_sparse()
+            user_neighbors = NeighborIndex.from_csr(sim, user_ids, topk=self.topk)
+            user_sim = similarity_to_dict(sim, user_ids)
+        else:
+            user_sim = self.user_similarity_best()
+            user_neighbors = NeighborIndex.from_dict(user_sim, topk=self.topk)
+        if self.sim_format == 'bin':
+            save_neighbor_index(user_neighbors, self.user_sim_file)
+            cache.save()
+            return load_neighbor_index(self.user_sim_file)
+
+        with codecs.open(self.user_sim_file, mode='w', encoding='utf8') as fp:
+            json.dump(user_sim, fp)
+        cache.save()
+        return user_neighbors
+
+    def update(self, events):
+        """
+        增量更新：把新的评分写入训练集，只重算受影响的用户的相似度和近邻，近邻索引中也只替换这些行
+        第一次调用时根据当前训练集构建同现矩阵
+        :param events: 新的评分记录[(user, item, rating)]
+        :return: 近邻发生变化的用户集合
+        """
+        if self.incremental is None:
+            self.logger.info('构建增量更新用的同现矩阵...')
+            self.incremental = IncrementalUserSimilarity(self.train_data, topk=self.topk)
+        affected = self.incremental.update(events)
+        self.user_neighbors = self.incremental.to_index()
+        # 训练集已经变化，列式训练集和历史评分矩阵不再可用
+        self.train_ratings = None
+        self.history, self.history_items = None, None
+        return affected
+
     def recommend(self, user, k=8, nitems=40):
         """
         为用户user进行物品推荐
         :param user: 用户user
-        :param k: 选取k个近邻用户
+        :param k: 选取k个近邻用户，最多为topk个
         :param nitems: 取nitems个物品
         :return:
         """
@@ -127,7 +290,7 @@ class UserCFRec(object):
         # have_score_items是用户user评价过的商品
         have_score_items = self.train_data.get(user, {})
         # v是用户user的相似用户，wuv是用户user和用户v的兴趣相似度
-        for v, wuv in sorted(self.user_sim[user].items(), key=lambda x: x[1], reverse=True)[0:k]:
+        for v, wuv in self.user_neighbors.neighbors(user, k):
             # i是用户v评价过的商品ID，rvi是用户v对商品i的评价
             for i, rvi in self.train_data[v].items():
                 if i in have_score_items:
@@ -138,6 +301,61 @@ class UserCFRec(object):
 
         return dict(sorted(result.items(), key=lambda x: x[1], reverse=True)[0:nitems])
 
+    def load_history(self):
+        """
+        构建训练集中所有用户的历史评分矩阵，行按近邻索引中的用户编码，只构建一次
+        :return: (history, item_ids)
+        """
+        if self.history is None:
+            matrix, user_ids, item_ids = self.train_matrix()
+            user_index = {user: row for row, user in enumerate(user_ids)}
+            self.history = select_rows(matrix, user_index, self.user_neighbors.ids)
+            self.history_items = item_ids
+
+        return self.history, self.history_items
+
+    def batch_scores(self, users, ks):
+        """
+        计算一批用户在不同近邻个数下的推荐分数
+        近邻按相似度名次分层累加，k个近邻的分数 = 上一个k的分数 + 新增名次近邻的贡献，所有k共用一次top-max(k)近邻的计算
+        :param users: 用户列表
+        :param ks: 近邻个数列表
+        :return: (users, seen, item_ids, {k: scores})，users只包含有近邻索引的用户，scores的列按item_ids编码
+        """
+        history, item_ids = self.load_history()
+        user_index = self.user_neighbors.id_index
+        users = [user for user in users if user in user_index]
+        rows = [user_index[user] for user in users]
+        scores_by_k = dict()
+        scores, start = None, 0
+        for k in sorted(set(ks)):
+            layer = self.user_neighbors.to_csr(k, start=start)[rows] @ history
+            scores = layer if scores is None else scores + layer
+            scores_by_k[k] = scores
+            start = k
+
+        return users, history[rows], item_ids, scores_by_k
+
+    def recommend_batch(self, users, k=8, nitems=40, batch_size=1000):
+        """
+        批量为用户进行推荐
+        只保留k个近邻的用户相似度矩阵乘以用户历史评分矩阵，一次得到一批用户对所有物品的推荐分数，
+        结果与逐个调用recommend一致(分数相同的物品顺序可能不同)
+        :param users: 用户列表
+        :param k: 选取k个近邻用户，最多为topk个
+        :param nitems: 每个用户返回n个物品
+        :param batch_size: 每批计算的用户数，决定了中间稠密矩阵的大小
+        :return: {user: {item: score}}，没有近邻的用户推荐结果为空
+        """
+        users = list(users)
+        result = {user: {} for user in users}
+        for start in range(0, len(users), batch_size):
+            block, seen, item_ids, scores_by_k = self.batch_scores(users[start:start + batch_size], [k])
+            for user, (cols, scores) in zip(block, select_top_n(scores_by_k[k], seen, nitems)):
+                result[user] = dict(zip([item_ids[col] for col in cols.tolist()], scores.tolist()))
+
+        return result
+
     def precision(self, k=8, nitems=10):
         """
         计算准确率
@@ -148,11 +366,13 @@ class UserCFRec(object):
         self.logger.info('开始计算准确率...')
         hit = 0
         precision = 0
-        for user in self.train_data.keys():
+        users = self.train_users()
+        ranks = self.recommend_batch(users, k=k, nitems=nitems)
+        for user in users:
             # tu: 用户实际评分的电影ID
             tu = self.test_data.get(user, {})
             # rank: 推荐系统推荐的电影ID
-            rank = self.recommend(user, k=k, nitems=nitems)
+            rank = ranks[user]
             for item, rate in rank.items():
                 if item in tu:
                     hit += 1
@@ -163,6 +383,19 @@ class UserCFRec(object):
         self.logger.info(f'precision: {precision}')
         return hit / (precision * 1.0)
 
+    def precision_grid(self, ks, nitems_list, processes=None):
+        """
+        多进程计算(k, nitems)参数网格上的准确率，结果与逐个调用precision一致
+        :param ks: 近邻个数列表
+        :param nitems_list: 推荐物品个数列表
+        :param processes: 进程数，为None时使用全部CPU
+        :return: {(k, nitems): precision}
+        """
+        self.logger.info('开始并行计算准确率...')
+        # 在fork子进程之前构建历史评分矩阵，子进程直接共享
+        self.load_history()
+        return evaluate_precision_grid(self, self.train_users(), ks, nitems_list, processes=processes)
+
 
 if __name__ == '__main__':
     logger = get_logger('user_cf_recommend')
@@ -171,9 +404,8 @@ if __name__ == '__main__':
     logger.info(f'user "1" recommend result is {result}')
     precision = cf.precision()
     logger.info(f'k=8, n=10, precision is {precision}')
-    for k in range(5, 10, 1):
-        for nitems in range(10, 20, 2):
-            precision = cf.precision(k=k, nitems=nitems)
-            logger.info(f'k = {k}, nitems={nitems}, precision is {precision}')
+    precisions = cf.precision_grid(ks=range(5, 10, 1), nitems_list=range(10, 20, 2))
+    for (k, nitems), precision in sorted(precisions.items()):
+        logger.info(f'k = {k}, nitems={nitems}, precision is {precision}')
 
 